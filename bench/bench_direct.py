@@ -0,0 +1,61 @@
+# Benchmark for turning a direct link to an audio file into a Song, with the tag probe
+# in bluez.probe and with youtube-dl. Needs ffmpeg on the PATH to make the test files.
+# Run from the top of the repository with: python -m bench.bench_direct [latency in seconds]
+
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+import bluez.probe as probe
+from bluez.song import songs_from_url
+
+from bench.media import *
+
+
+RUNS = 5
+
+
+
+async def time_song(url):
+    started = time.perf_counter()
+    songs = (await songs_from_url(url, None))
+    return time.perf_counter() - started, songs[0]
+
+
+
+async def main(latency):
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = make_fixtures(directory)
+        async def stream(request):
+            # a link without an extension, which only says what it is in its content type
+            return web.FileResponse(fixtures['mp3'], headers={'Content-Type': 'audio/mpeg'})
+        runner, base_url = (await serve(directory, latency, [('/stream', stream)]))
+        try:
+            # warm up both paths
+            for direct in (True, False):
+                probe.BLUEZ_DIRECT_MEDIA = direct
+                await songs_from_url(f'{base_url}/fixture.mp3', None)
+            print(f'median time from link to Song over {RUNS} runs, {latency * 1000:.0f} ms per request:')
+            for path in [f'/fixture.{ext}' for ext in ('mp3', 'ogg', 'flac', 'm4a')] + ['/stream']:
+                results = {}
+                for direct in (True, False):
+                    probe.BLUEZ_DIRECT_MEDIA = direct
+                    runs = [(await time_song(base_url + path)) for i in range(RUNS)]
+                    song = runs[-1][1]
+                    results[direct] = (statistics.median(t for t, song in runs) * 1000, song.length)
+                print(f'  {path:14} direct {results[True][0]:7.1f} ms ({results[True][1]:.1f} s long)   '
+                      f'youtube-dl {results[False][0]:7.1f} ms ({results[False][1]:.1f} s long)')
+        finally:
+            probe.BLUEZ_DIRECT_MEDIA = True
+            if probe.probe_session is not None:
+                await probe.probe_session.close()
+            await runner.cleanup()
+
+
+
+if __name__ == '__main__':
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 0))
@@ -0,0 +1,136 @@
+# Benchmarks for bluez.songqueue.SongQueue against the deque the queue used to be.
+# Run from the top of the repository with: python -m bench.bench_songqueue
+
+
+
+import collections
+import random
+import time
+
+from bluez.song import Song
+from bluez.songqueue import SongQueue
+
+
+
+def make_song(k, rnd):
+    # A Song without going through yt-dlp
+    song = Song.__new__(Song)
+    song.name = f'song {k}'
+    song.link = f'https://example.com/{k}'
+    song.user = None
+    song.queue = None
+    song.queue_block = None
+    song.length = rnd.randrange(60, 600)
+    return song
+
+
+
+def timed(f):
+    t = time.perf_counter()
+    f()
+    return (time.perf_counter() - t) * 1000
+
+
+
+def bench_edits(n, rnd):
+    # Priority playlists spliced into the middle, random moves, range deletes and pages
+    songs = [make_song(k, rnd) for k in range(n)]
+    extra = [make_song(k, rnd) for k in range(n, n + 200)]
+    for name, make in (('deque', collections.deque), ('SongQueue', SongQueue)):
+        r = random.Random(1)
+        q = make(songs)
+        def splice():
+            for rep in range(20):
+                if name == 'deque':
+                    for song in reversed(extra):
+                        q.insert(n // 2, song)
+                else:
+                    q.splice(n // 2, extra)
+        t_splice = timed(splice)
+        q = make(songs)
+        def move():
+            for rep in range(2000):
+                i = r.randrange(len(q))
+                song = q[i]
+                del q[i]
+                q.insert(r.randrange(len(q) + 1), song)
+        t_move = timed(move)
+        q = make(songs)
+        def delete():
+            for rep in range(20):
+                a = len(q) // 2
+                if name == 'deque':
+                    # the way remove_range used to do it
+                    for song in tuple(q)[a:a+500]:
+                        q.remove(song)
+                else:
+                    q.delete_range(a, a + 500)
+        t_delete = timed(delete)
+        q = make(songs)
+        def page():
+            for rep in range(200):
+                a = r.randrange(len(q) - 10)
+                if name == 'deque':
+                    tuple(q)[a:a+10]
+                else:
+                    q[a:a+10]
+        t_page = timed(page)
+        print(f'{name:<9} n={n:6d}: splice x20 {t_splice:8.1f} ms  move x2000 {t_move:8.1f} ms  '
+              f'range-del x20 {t_delete:8.1f} ms  page x200 {t_page:7.1f} ms')
+
+
+
+def bench_fragmentation(n, rnd):
+    # Lots of small splices used to leave the queue in thousands of tiny blocks
+    q = SongQueue(make_song(k, rnd) for k in range(n))
+    r = random.Random(2)
+    k = n
+    for rep in range(4000):
+        q.splice(r.randrange(len(q) + 1), [make_song(k, rnd), make_song(k + 1, rnd)])
+        k += 2
+    t_splice = timed(lambda: q.splice(len(q) // 2, [make_song(k, rnd), make_song(k + 1, rnd)]))
+    def move():
+        for rep in range(1000):
+            song = q.pop(r.randrange(len(q)))
+            q.insert(r.randrange(len(q) + 1), song)
+    t_move = timed(move)
+    print(f'SongQueue n={n:6d} after 4000 small splices: {len(q.blocks)} blocks, one splice {t_splice:.2f} ms, '
+          f'move x1000 {t_move:.1f} ms')
+
+
+
+def bench_shuffle(n, rnd):
+    # random.shuffle() swaps songs one at a time by index, which is slow on a SongQueue
+    songs = [make_song(k, rnd) for k in range(n)]
+    d = collections.deque(songs)
+    q = SongQueue(songs)
+    t_deque = timed(lambda: random.shuffle(d))
+    t_swaps = timed(lambda: random.shuffle(q))
+    t_shuffle = timed(q.shuffle)
+    print(f'shuffle   n={n:6d}: random.shuffle(deque) {t_deque:.0f} ms, random.shuffle(SongQueue) {t_swaps:.0f} ms, '
+          f'SongQueue.shuffle() {t_shuffle:.1f} ms')
+
+
+
+def bench_totals(n, rnd):
+    songs = [make_song(k, rnd) for k in range(n)]
+    d = collections.deque(songs)
+    q = SongQueue(songs)
+    t_sum = timed(lambda: sum(song.length for song in d))
+    print(f'totals    n={n:6d}: sum over deque {t_sum:.2f} ms, SongQueue.total_length() {timed(q.total_length):.3f} ms')
+
+
+
+def main():
+    rnd = random.Random(0)
+    for n in (10000, 100000):
+        bench_edits(n, rnd)
+    bench_fragmentation(10000, rnd)
+    for n in (10000, 100000):
+        bench_shuffle(n, rnd)
+        bench_totals(n, rnd)
+
+
+
+if __name__ == '__main__':
+    main()
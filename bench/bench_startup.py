@@ -0,0 +1,56 @@
+# Benchmark for the time from starting ffmpeg to its first frame of audio, with and without
+# the input format hints Song.get_input_hints() gives it. Needs ffmpeg on the PATH.
+# Run from the top of the repository with: python -m bench.bench_startup [latency in seconds]
+
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+
+from bluez.audio import *
+from bluez.song import INPUT_FORMATS, PROBE_SIZE
+
+from bench.media import *
+
+
+RUNS = 7
+
+
+
+def time_to_first_frame(url, before_options):
+    started = time.monotonic()
+    source = BufferedSource(FFmpegPCMAudio(url, before_options=before_options, options='-vn'))
+    try:
+        if not source.read():
+            raise RuntimeError(f'no audio from {url}')
+        return time.monotonic() - started
+    finally:
+        source.cleanup()
+
+
+
+async def main(latency):
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = make_fixtures(directory)
+        runner, base_url = (await serve(directory, latency))
+        try:
+            print(f'median time to first frame over {RUNS} runs, {latency * 1000:.0f} ms per request:')
+            for ext in fixtures:
+                url = f'{base_url}/fixture.{ext}'
+                results = {}
+                for name, before_options in (('probed', ''),
+                                             ('hinted', f'-f {INPUT_FORMATS[ext]} -probesize {PROBE_SIZE} -analyzeduration 0')):
+                    # ffmpeg blocks, so run it off the event loop that is serving the files
+                    times = [(await loop.run_in_executor(None, time_to_first_frame, url, before_options))
+                             for i in range(RUNS)]
+                    results[name] = statistics.median(times) * 1000
+                print(f'  {ext:5} probed {results["probed"]:7.1f} ms   hinted {results["hinted"]:7.1f} ms')
+        finally:
+            await runner.cleanup()
+
+
+
+if __name__ == '__main__':
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.05))
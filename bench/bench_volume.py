@@ -0,0 +1,59 @@
+# Benchmark for the cost of volume handling per 20 ms frame of PCM audio (see bluez.audio.VolumeTransformer).
+# Run from the top of the repository with: python -m bench.bench_volume
+
+import array
+import timeit
+
+import bluez.audio as audio
+
+
+FRAME = array.array('h', (int(20000 * ((i * 7919) % 65536 - 32768) / 32768) for i in range(1920))).tobytes()
+
+
+
+class Source(object):
+    # An audio source that returns the same frame forever
+    def read(self):
+        return FRAME
+    def is_opus(self):
+        return False
+    def cleanup(self):
+        pass
+
+
+
+def per_frame(f, number=2000):
+    return min(timeit.repeat(f, number=number, repeat=5)) / number * 1e6
+
+
+
+def main():
+    print(f'per {len(FRAME)}-byte frame:')
+    source = audio.VolumeTransformer(Source(), 0.5)
+    print(f'  volume applied by ffmpeg (no scaling here): {per_frame(source.read):8.2f} us')
+    source.set_volume(0.8)
+    saved = (audio.audioop, audio.numpy)
+    try:
+        try:
+            import audioop # what discord.PCMVolumeTransformer uses (removed in python 3.13)
+        except ImportError:
+            pass
+        else:
+            audio.audioop, audio.numpy = audioop, None
+            print(f'  live volume change with audioop:           {per_frame(source.read):8.2f} us')
+        try:
+            import numpy
+        except ImportError:
+            pass
+        else:
+            audio.audioop, audio.numpy = None, numpy
+            print(f'  live volume change with numpy:             {per_frame(source.read):8.2f} us')
+        audio.audioop, audio.numpy = None, None
+        print(f'  live volume change with the array fallback:{per_frame(source.read, 50):8.2f} us')
+    finally:
+        audio.audioop, audio.numpy = saved
+
+
+
+if __name__ == '__main__':
+    main()
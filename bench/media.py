@@ -0,0 +1,53 @@
+# Test media and a local HTTP server standing in for a CDN, shared by the benchmarks
+
+
+
+import asyncio
+import os
+import subprocess
+
+from aiohttp import web
+
+
+# file extension -> ffmpeg output options for a test track in that format
+FIXTURE_FORMATS = {
+    'mp3'  : ['-c:a', 'libmp3lame', '-b:a', '128k'],
+    'm4a'  : ['-c:a', 'aac', '-b:a', '128k'],
+    'webm' : ['-c:a', 'libopus', '-b:a', '128k'],
+    'ogg'  : ['-c:a', 'libvorbis', '-q:a', '4'],
+    'flac' : ['-c:a', 'flac'],
+    }
+
+
+
+def make_fixtures(directory, seconds=60):
+    # Write a tagged test track in each format to a directory (using ffmpeg), unless it is there
+    # already, and return a dict extension -> path
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for ext, options in FIXTURE_FORMATS.items():
+        path = paths[ext] = os.path.join(directory, f'fixture.{ext}')
+        if not os.path.exists(path):
+            subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                            '-ac', '2', '-ar', '48000', '-metadata', 'title=Fixture', '-metadata', 'artist=Bench']
+                           + options + [path], check=True)
+    return paths
+
+
+
+async def serve(directory, latency=0, routes=()):
+    # Serve the files in a directory over HTTP on the loopback interface, waiting the given number
+    # of seconds before answering each request. Returns (runner, base URL); clean up the runner after.
+    @web.middleware
+    async def delay(request, handler):
+        await asyncio.sleep(latency)
+        return (await handler(request))
+    app = web.Application(middlewares=[delay])
+    for path, handler in routes:
+        app.router.add_get(path, handler)
+    app.router.add_static('/', directory)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}'
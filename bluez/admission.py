@@ -0,0 +1,149 @@
+# Process-wide limits on how many ffmpeg processes may run at once
+
+import asyncio
+import collections
+import itertools
+import os
+import time
+
+from bluez.metrics import *
+
+
+BLUEZ_MAX_FFMPEG = int(os.getenv('BLUEZ_MAX_FFMPEG', '32'))
+BLUEZ_MAX_FFMPEG_PER_GUILD = int(os.getenv('BLUEZ_MAX_FFMPEG_PER_GUILD', '3'))
+
+# Priorities of requests to start ffmpeg; lower numbers go first
+PRIORITY_PLAY = 0 # audio that somebody is waiting to hear
+PRIORITY_PREFETCH = 1 # audio for the next song
+PRIORITY_BACKGROUND = 2 # transcoding and analysis
+
+BACKGROUND = 'background' # the group that background jobs are counted against
+
+
+
+
+class Superseded(Exception):
+
+    # Raised from Admission.acquire() when a newer request with the same key replaces this one
+
+    pass
+
+
+
+
+class Ticket(object):
+
+    # Permission to run one ffmpeg process. Release it once the process has exited.
+
+    def __init__(self, admission, group):
+        self.admission = admission
+        self.group = group
+        self.released = False
+
+    def release(self):
+        # This may be called from any thread, and more than once
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.admission.loop.call_soon_threadsafe(self.admission.release, self)
+        except RuntimeError:
+            pass # the event loop has been closed
+
+
+
+
+class Request(object):
+
+    # A request to start ffmpeg that is waiting for a ticket
+
+    def __init__(self, group, key, priority, seq, future):
+        self.group = group
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.created = time.monotonic()
+
+
+
+
+class Admission(object):
+
+    # Hands out tickets to start ffmpeg so that there are never more than a certain number of
+    # processes running in total, or for any one guild. When there are no tickets to spare,
+    # requests wait in a queue which is served in order of priority, and then to whichever
+    # guild has the fewest processes running, so one busy guild can't starve the rest.
+    # A request may have a key; a newer request with the same key cancels the older one if
+    # it is still waiting, since whatever it was going to play is out of date.
+
+    def __init__(self, max_processes=BLUEZ_MAX_FFMPEG, max_per_group=BLUEZ_MAX_FFMPEG_PER_GUILD):
+        self.max_processes = max_processes
+        self.max_per_group = max_per_group
+        self.loop = None
+        self.running = collections.Counter() # group -> number of tickets held
+        self.total = 0
+        self.waiting = [] # list of Request
+        self.counter = itertools.count()
+
+
+    async def acquire(self, group, key=None, priority=PRIORITY_PLAY, timeout=None):
+        # Wait for a ticket to start an ffmpeg process, counted against the given group
+        self.loop = asyncio.get_running_loop()
+        if key is not None:
+            for request in self.waiting:
+                if (request.key == key) and not request.future.done():
+                    request.future.set_exception(Superseded('superseded by a newer request'))
+                    metrics.increment('ffmpeg_superseded')
+            self.waiting = [request for request in self.waiting if not request.future.done()]
+        request = Request(group, key, priority, next(self.counter), self.loop.create_future())
+        self.waiting.append(request)
+        self.dispatch()
+        try:
+            ticket = (await asyncio.wait_for(asyncio.shield(request.future), timeout))
+        except BaseException:
+            # we stopped waiting, so give back the ticket if we got one anyway
+            if request.future.done() and not request.future.cancelled() and not request.future.exception():
+                request.future.result().release()
+            else:
+                request.future.cancel()
+            self.waiting = [other for other in self.waiting if other is not request]
+            self.update_metrics()
+            raise
+        metrics.sample('ffmpeg_admission_wait', time.monotonic() - request.created)
+        return ticket
+
+
+    def release(self, ticket):
+        # Give back a ticket (this runs on the event loop; use Ticket.release() instead)
+        self.running[ticket.group] -= 1
+        if self.running[ticket.group] <= 0:
+            del self.running[ticket.group]
+        self.total -= 1
+        self.dispatch()
+
+
+    def dispatch(self):
+        # Hand out as many tickets as we can to the waiting requests
+        while self.total < self.max_processes:
+            eligible = [request for request in self.waiting
+                        if (self.running[request.group] < self.max_per_group) and not request.future.done()]
+            if not eligible:
+                break
+            request = min(eligible, key=lambda request: (request.priority, self.running[request.group], request.seq))
+            self.waiting.remove(request)
+            self.running[request.group] += 1
+            self.total += 1
+            request.future.set_result(Ticket(self, request.group))
+        self.waiting = [request for request in self.waiting if not request.future.done()]
+        self.update_metrics()
+
+
+    def update_metrics(self):
+        metrics.set('ffmpeg_running', self.total)
+        metrics.set('ffmpeg_waiting', len(self.waiting))
+
+
+
+
+admission = Admission()
@@ -0,0 +1,176 @@
+# Background analysis of tracks (loudness and silence) with ffmpeg
+
+import asyncio
+import os
+import re
+import shlex
+import logging
+
+from bluez.admission import *
+from bluez.metrics import *
+from bluez.trackdb import *
+from bluez.util import *
+
+
+BLUEZ_ANALYSIS = bool(int(os.getenv('BLUEZ_ANALYSIS', '0'))) # opt-in, since each track costs an extra ffmpeg run and a second fetch of its audio
+BLUEZ_ANALYSIS_WORKERS = int(os.getenv('BLUEZ_ANALYSIS_WORKERS', '1'))
+BLUEZ_LOUDNESS_TARGET = float(os.getenv('BLUEZ_LOUDNESS_TARGET', '-14')) # LUFS
+BLUEZ_TRIM_SILENCE = bool(int(os.getenv('BLUEZ_TRIM_SILENCE', '1')))
+
+MAX_NORMALIZE_GAIN_DB = 12 # never boost a quiet track by more than this
+MAX_PEAK_DB = -1 # never boost a track so much that its true peak goes above this
+MAX_ANALYSIS_LENGTH = 3 * 3600 # don't bother analyzing anything longer than this many seconds
+ANALYSIS_TIMEOUT = 300
+SILENCE_THRESHOLD_DB = -50 # anything quieter than this counts as silence
+SILENCE_MIN_DURATION = 0.5 # seconds
+SILENCE_TOLERANCE = 0.1 # how close to the start or end of a track silence has to be to count as leading or trailing
+
+# the fields analyze() stores for each track
+ANALYSIS_FIELDS = ('loudness', 'peak', 'audio_start', 'audio_end')
+
+LOUDNESS_RE = re.compile(r'^\s*I:\s*(-?[\d.]+|-inf) LUFS', re.M)
+PEAK_RE = re.compile(r'^\s*Peak:\s*(-?[\d.]+|-inf) dBFS', re.M)
+SILENCE_RE = re.compile(r'silence_(start|end): (-?[\d.]+)')
+TIME_RE = re.compile(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+
+
+def parse_level(match):
+    # Convert a level printed by ffmpeg to a float, or None if it was -inf
+    if match is None:
+        raise ValueError('missing from ffmpeg output')
+    value = match.group(1)
+    return None if value == '-inf' else float(value)
+
+
+def find_silence(output):
+    # Work out where the audio starts and ends from the output of the silencedetect filter.
+    # Returns a tuple (audio_start, audio_end), where audio_end is None if there is no silence at the end.
+    silences = []
+    for kind, time in SILENCE_RE.findall(output):
+        if kind == 'start':
+            silences.append([float(time), None])
+        elif silences:
+            silences[-1][1] = float(time)
+    times = TIME_RE.findall(output)
+    if not (silences and times):
+        return (0, None)
+    hours, minutes, seconds = times[-1]
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    audio_start = 0
+    audio_end = None
+    first_start, first_end = silences[0]
+    if (first_start <= SILENCE_TOLERANCE) and (first_end is not None) and (first_end < duration - SILENCE_TOLERANCE):
+        audio_start = first_end
+    last_start, last_end = silences[-1]
+    if (last_start > audio_start) and ((last_end is None) or (last_end >= duration - SILENCE_TOLERANCE)):
+        audio_end = last_start
+    return (audio_start, audio_end)
+
+
+def loudness_gain(loudness, peak):
+    # Get the gain that brings a track with the given integrated loudness (LUFS)
+    # and true peak (dBFS) to the target loudness, as a multiplier
+    if loudness is None:
+        return 1.0 # silence
+    gain_db = min(BLUEZ_LOUDNESS_TARGET - loudness, MAX_NORMALIZE_GAIN_DB)
+    if (gain_db > 0) and (peak is not None):
+        gain_db = max(min(gain_db, MAX_PEAK_DB - peak), 0)
+    return 10 ** (gain_db / 20)
+
+
+
+
+class Analyzer(object):
+
+    # A pool of background workers that decode each track once to measure its loudness
+    # and find any silence at either end, and store the results in the track database
+
+    def __init__(self, workers=BLUEZ_ANALYSIS_WORKERS):
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.jobs = {} # key -> future resolved once the track has been analyzed (or failed to be)
+
+
+    def start(self):
+        # Start the worker tasks
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for i in range(self.workers)]
+
+
+    def submit(self, key, get_url, before_options=''):
+        # Queue a track to be analyzed, unless it has been already. get_url is a
+        # coroutine function returning the URL to read the track from; it is not
+        # called until a worker gets to the track, so the URL is fresh.
+        if all(trackdb.has(key, field) for field in ANALYSIS_FIELDS) or (key in self.jobs):
+            return
+        if self.queue is None:
+            self.start()
+        self.jobs[key] = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((key, get_url, before_options))
+        metrics.set('analysis_queue', self.queue.qsize())
+
+
+    async def wait(self, key):
+        # Wait for a track to finish being analyzed, if it is being analyzed
+        future = self.jobs.get(key)
+        if future is not None:
+            await asyncio.shield(future)
+
+
+    async def worker(self):
+        while True:
+            key, get_url, before_options = (await self.queue.get())
+            future = self.jobs[key]
+            try:
+                url = (await get_url())
+                results = (await self.analyze(url, before_options))
+                trackdb.update(key, **results)
+            except Exception as e:
+                logging.warning(f'unable to analyze {key}: {e!r}')
+            finally:
+                del self.jobs[key]
+                future.set_result(None)
+                metrics.set('analysis_queue', self.queue.qsize())
+
+
+    async def analyze(self, url, before_options=''):
+        # Analyze a track once the admission controller lets us start ffmpeg
+        ticket = (await admission.acquire(BACKGROUND, priority=PRIORITY_BACKGROUND))
+        try:
+            return (await asyncio.wait_for(self.run_ffmpeg(url, before_options), ANALYSIS_TIMEOUT))
+        finally:
+            ticket.release()
+
+
+    async def run_ffmpeg(self, url, before_options):
+        # Decode a track and return a dict of measurements
+        process = (await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-hide_banner', '-nostats', *shlex.split(before_options), '-i', url, '-vn',
+            '-af', f'silencedetect=n={SILENCE_THRESHOLD_DB}dB:d={SILENCE_MIN_DURATION},ebur128=peak=true:framelog=verbose',
+            '-f', 'null', '-',
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE))
+        try:
+            stdout, stderr = (await process.communicate())
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        stderr = stderr.decode('latin-1')
+        if process.returncode != 0:
+            raise RuntimeError(stderr.strip().splitlines()[-1] if stderr.strip() else
+                               f'ffmpeg exited with code {process.returncode}')
+        # the loudness summary comes last, so only look there
+        summary = stderr[stderr.rfind('Summary:'):]
+        audio_start, audio_end = find_silence(stderr)
+        metrics.increment('analyzed_tracks')
+        return {'loudness': parse_level(LOUDNESS_RE.search(summary)),
+                'peak': parse_level(PEAK_RE.search(summary)),
+                'audio_start': audio_start,
+                'audio_end': audio_end}
+
+
+
+
+analyzer = Analyzer()
@@ -0,0 +1,395 @@
+# Audio source classes
+
+import discord
+import subprocess
+import threading
+import collections
+import array
+import sys
+import re
+import time
+import logging
+
+from bluez.metrics import *
+from bluez.util import *
+
+try:
+    import audioop # the fastest way to scale samples, but removed in Python 3.13
+    numpy = None
+except ImportError:
+    audioop = None
+    try:
+        import numpy
+    except ImportError:
+        # fall back to scaling the samples one at a time
+        numpy = None
+
+
+MAX_STDERR_ERRORS = 20 # the maximum number of non-fatal error lines to remember per ffmpeg process
+STDERR_JOIN_TIMEOUT = 1.0 # how long to wait for ffmpeg to finish writing to stderr once its output ends
+WARNING_LOG_INTERVAL = 60 # the minimum number of seconds between log messages for the same kind of warning
+READAHEAD_FRAMES = 150 # how many 20 ms frames of audio to buffer ahead of the voice client
+UNDERRUN_TIMEOUT = 0.02 # how long to wait for a frame that has not been buffered yet before playing silence
+FILL_REPORT_INTERVAL = 50 # how often (in frames) to report the buffer fill level
+
+PCM_SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+
+# Classes of messages that ffmpeg writes to stderr
+FFMPEG_BENIGN = 'benign' # not worth complaining about; logged, but rate-limited
+FFMPEG_ERROR = 'error'   # reported to the user once the song has finished playing
+FFMPEG_FATAL = 'fatal'   # playback cannot continue; reported to the user immediately
+
+
+FFMPEG_MESSAGE_PATTERNS = (
+    # (regular expression, message class)
+    # the first pattern that matches a line determines its class; lines that
+    # do not match any pattern are classified by their log level instead
+    (re.compile(r'Connection reset by peer'), FFMPEG_BENIGN), # these are not worth complaining about
+    (re.compile(r'Estimating duration from bitrate'), FFMPEG_BENIGN), # this is a warning, not an error
+    (re.compile(r'Output file is empty, nothing was encoded'), FFMPEG_BENIGN), # the user messed with the audio effects right as a song was ending
+    (re.compile(r'Error in the pull function'), FFMPEG_BENIGN), # these are not worth complaining about either
+    (re.compile(r'Server returned [45]\d\d'), FFMPEG_FATAL),
+    (re.compile(r'HTTP error [45]\d\d'), FFMPEG_FATAL),
+    (re.compile(r'No such file or directory'), FFMPEG_FATAL),
+    (re.compile(r'Invalid data found when processing input'), FFMPEG_FATAL),
+    (re.compile(r'Error opening (input|output|filters?)'), FFMPEG_FATAL),
+    (re.compile(r'Connection refused'), FFMPEG_FATAL),
+    (re.compile(r'Failed to resolve hostname'), FFMPEG_FATAL),
+    )
+
+
+# ffmpeg is run with -loglevel level+warning, so each line it writes is tagged with
+# its log level, e.g. "[https @ 0x55d1c0a3e440] [error] HTTP error 403 Forbidden"
+FFMPEG_LEVEL_RE = re.compile(r'^((?:\[[^\]]*\]\s*)*?)\[(panic|fatal|error|warning)\]\s*')
+
+FFMPEG_LEVEL_CLASSES = {
+    'panic'   : FFMPEG_FATAL,
+    'fatal'   : FFMPEG_FATAL,
+    'error'   : FFMPEG_ERROR,
+    'warning' : FFMPEG_BENIGN,
+    }
+
+
+
+
+class FFmpegError(Exception):
+
+    # An error message written by ffmpeg to its stderr
+
+    def __init__(self, message, fatal=False):
+        Exception.__init__(self, message)
+        self.fatal = fatal
+
+
+
+
+def classify_ffmpeg_message(line):
+    # Given a line written by ffmpeg to stderr, return a tuple (message class, message)
+    # where the message has had its log level tag removed
+    match = FFMPEG_LEVEL_RE.match(line)
+    if match:
+        level = match.group(2)
+        message = match.group(1) + line[match.end():]
+    else:
+        level = None
+        message = line
+    for pattern, kind in FFMPEG_MESSAGE_PATTERNS:
+        if pattern.search(message):
+            return kind, message
+    return FFMPEG_LEVEL_CLASSES.get(level, FFMPEG_ERROR), message
+
+
+
+
+class RateLimitedLog(object):
+
+    # Logs warnings, but only once per interval for each kind of warning.
+    # Shared between the stderr reader threads of every ffmpeg process.
+
+    def __init__(self, interval=WARNING_LOG_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_logged = {}
+        self.suppressed = {}
+
+    def warning(self, key, message):
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_logged.get(key)
+            if (last is not None) and (now - last < self.interval):
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return
+            self.last_logged[key] = now
+            n = self.suppressed.pop(key, 0)
+        if n:
+            message += f' ({n} similar message{plural(n)} suppressed)'
+        logging.warning(message)
+
+
+ffmpeg_warnings = RateLimitedLog()
+
+
+def warning_key(message):
+    # Group warnings that differ only in addresses and numbers together for rate-limiting
+    return re.sub(r'0x[0-9a-f]+|\d+', '#', message)
+
+
+
+
+class FFmpegStderrMixin(object):
+
+    # Mixin for discord's ffmpeg audio sources that consumes the stderr of the
+    # ffmpeg process on a background thread, classifying each line as it arrives.
+    # Fatal errors are raised from read() right away so that the voice client's
+    # "after" callback receives them; other errors are raised once the output ends.
+
+    ticket = None # the admission ticket for the ffmpeg process, given back on cleanup
+
+    def _spawn_process(self, args, **subprocess_kwargs):
+        subprocess_kwargs['stderr'] = subprocess.PIPE
+        self._errors = []
+        self._fatal_error = None
+        self._killed = False
+        process = super()._spawn_process(args, **subprocess_kwargs)
+        self._stderr_thread = threading.Thread(target=self._read_stderr, args=(process.stderr,),
+                                               name=f'ffmpeg-stderr:pid-{process.pid}', daemon=True)
+        self._stderr_thread.start()
+        return process
+
+    def _check_process_returncode(self):
+        # newer versions of discord.py look at the exit code of ffmpeg to detect errors;
+        # we get that information from stderr ourselves, so this does nothing
+        pass
+
+    def _read_stderr(self, pipe):
+        # Read and handle lines from the stderr of the ffmpeg process until it closes
+        try:
+            for line in iter(pipe.readline, b''):
+                line = line.decode('latin-1').strip()
+                if line and not self._killed:
+                    self._handle_stderr_line(line)
+        except (OSError, ValueError):
+            pass # the pipe was closed out from under us
+        finally:
+            pipe.close()
+
+    def _handle_stderr_line(self, line):
+        kind, message = classify_ffmpeg_message(line)
+        if kind == FFMPEG_FATAL:
+            if self._fatal_error is None:
+                self._fatal_error = FFmpegError(message, fatal=True)
+        elif kind == FFMPEG_ERROR:
+            if len(self._errors) < MAX_STDERR_ERRORS:
+                self._errors.append(message)
+        else:
+            ffmpeg_warnings.warning(warning_key(message), message)
+
+    def _check_errors(self, eof=False):
+        # raise an exception if ffmpeg has reported an error
+        if eof:
+            # the output has ended, so give ffmpeg a moment to finish explaining why
+            self._stderr_thread.join(STDERR_JOIN_TIMEOUT)
+        if self._fatal_error is not None:
+            raise self._fatal_error
+        if eof and self._errors:
+            raise FFmpegError('\n'.join(self._errors))
+
+    def read(self):
+        self._check_errors()
+        data = super().read()
+        if not data:
+            self._check_errors(eof=True)
+        return data
+
+    def cleanup(self):
+        # anything ffmpeg complains about after we kill it is not worth reporting
+        self._killed = True
+        super().cleanup()
+        if self.ticket is not None:
+            self.ticket.release()
+
+
+
+
+class FFmpegPCMAudio(FFmpegStderrMixin, discord.FFmpegPCMAudio):
+
+    # PCM audio source that classifies ffmpeg's stderr output
+
+    def __init__(self, source, before_options=None, options=None):
+        options = f'{options or ""} -loglevel level+warning'
+        discord.FFmpegPCMAudio.__init__(self, source, before_options=before_options, options=options)
+
+
+
+
+class FFmpegOpusAudio(FFmpegStderrMixin, discord.FFmpegOpusAudio):
+
+    # Opus audio source that classifies ffmpeg's stderr output
+
+    def __init__(self, source, codec=None, before_options=None, options=None):
+        options = f'{options or ""} -loglevel level+warning'
+        discord.FFmpegOpusAudio.__init__(self, source, codec=codec, before_options=before_options, options=options)
+
+
+
+
+class BufferedSource(discord.AudioSource):
+
+    # Wraps another audio source, reading ahead from it on a background thread into a
+    # bounded buffer of frames, so that a stall upstream of ffmpeg does not stall the
+    # voice client. If the buffer runs dry, silence is played until it fills back up.
+
+    def __init__(self, original, maxframes=READAHEAD_FRAMES, startup_metric='startup'):
+        self.original = original
+        self.startup_metric = startup_metric
+        self.created = time.monotonic()
+        self.maxframes = maxframes
+        self.silence = OPUS_SILENCE if original.is_opus() else PCM_SILENCE
+        self.frames = collections.deque()
+        self.condition = threading.Condition()
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.underruns = 0
+        self.nread = 0
+        self.first_frame_time = None
+        self.eof_time = None
+        self.gap_start = None
+        self.thread = threading.Thread(target=self._fill, name=f'audio-readahead:{id(self):#x}', daemon=True)
+        self.thread.start()
+
+    @property
+    def fill(self):
+        # the fraction of the buffer that is currently full
+        return len(self.frames) / self.maxframes
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def _fill(self):
+        # Keep the buffer topped up until the original source runs out
+        try:
+            data = self.original.read()
+            if data:
+                # measure how long it took ffmpeg to produce any audio at all
+                metrics.sample(self.startup_metric, time.monotonic() - self.created)
+            while True:
+                with self.condition:
+                    if self.stopped:
+                        return
+                    if not data:
+                        self.eof = True
+                        self.condition.notify_all()
+                        return
+                    self.frames.append(data)
+                    self.condition.notify_all()
+                    while (len(self.frames) >= self.maxframes) and not self.stopped:
+                        self.condition.wait()
+                data = self.original.read()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def prime(self, nframes, timeout=None):
+        # Wait until the first few frames have been buffered, so that playback can start
+        # immediately once this source is handed to a voice client.
+        # This blocks, so it should be run in an executor.
+        with self.condition:
+            self.condition.wait_for(lambda: (len(self.frames) >= min(nframes, self.maxframes)) or
+                                    self.eof or (self.error is not None), timeout)
+
+    def read(self):
+        with self.condition:
+            if getattr(self.error, 'fatal', False):
+                # don't make anyone listen to the rest of the buffer if the stream is broken
+                raise self.error
+            if not self.frames:
+                if self.first_frame_time is None:
+                    # wait as long as it takes for the stream to get going
+                    self.condition.wait_for(lambda: self.frames or self.eof or (self.error is not None))
+                else:
+                    self.condition.wait_for(lambda: self.frames or self.eof or (self.error is not None),
+                                            UNDERRUN_TIMEOUT)
+            if self.frames:
+                data = self.frames.popleft()
+                self.condition.notify_all()
+            elif self.error is not None:
+                raise self.error
+            elif self.eof:
+                data = b''
+            else:
+                # the buffer ran dry; play silence rather than stalling the voice client
+                self.underruns += 1
+                metrics.increment('buffer_underruns')
+                return self.silence
+        self.nread += 1
+        if self.first_frame_time is None:
+            self.first_frame_time = time.monotonic()
+            if self.gap_start is not None:
+                # this source is picking up where the previous song left off
+                metrics.sample('track_gap', self.first_frame_time - self.gap_start)
+        if not data:
+            self.eof_time = time.monotonic()
+        elif self.nread % FILL_REPORT_INTERVAL == 0:
+            metrics.set('buffer_fill', self.fill)
+        return data
+
+    def cleanup(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.original.cleanup()
+
+
+
+
+def scale_pcm(data, volume):
+    # Multiply 16-bit signed PCM samples by a volume factor, clipping the result
+    if audioop is not None:
+        return audioop.mul(data, 2, volume)
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype=numpy.int16) * volume
+        return numpy.clip(samples, -32768, 32767).astype(numpy.int16).tobytes()
+    samples = array.array('h', data)
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    samples = array.array('h', [min(max(int(sample * volume), -32768), 32767) for sample in samples])
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+
+
+class VolumeTransformer(discord.AudioSource):
+
+    # Allows the volume of a PCM source to be changed while it is playing.
+    # The volume a source starts out with is applied by ffmpeg's filter graph,
+    # so samples only need to be scaled here after a live volume change.
+
+    def __init__(self, original, volume=1.0):
+        self.original = original
+        self.base_volume = volume # the volume ffmpeg is applying
+        self.scale = 1.0
+
+    def set_volume(self, volume):
+        # Change the volume; return False if it can't be done without restarting ffmpeg
+        if self.base_volume <= 0:
+            return (volume <= 0)
+        self.scale = volume / self.base_volume
+        return True
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def read(self):
+        data = self.original.read()
+        if data and (self.scale != 1.0):
+            data = scale_pcm(data, self.scale)
+        return data
+
+    def cleanup(self):
+        self.original.cleanup()
@@ -17,6 +17,7 @@ from bluez.song import *
 from bluez.views import *
 from bluez.lyrics import *
 from bluez.timezones import *
+from bluez.metrics import *
 from bluez.util import *
 
 
@@ -79,6 +80,7 @@ async def on_ready():
     # Creates a player for each guild and syncs the application commands
     for guild in bot.guilds:
         player_map[guild.id] = Player(bot, guild)
+    library.start()
     await bot.tree.sync()
 
 
@@ -1216,3 +1218,13 @@ if BLUEZ_DEBUG:
         os.spawnl(os.P_NOWAIT, BLUEZ_COMMAND)
 
 
+    @bot.hybrid_command(name='stats')
+    async def command_stats(ctx):
+        '''Show performance metrics. Only available in debug mode.'''
+        report = metrics.report()
+        if report:
+            await ctx.send(f'```\n{report}\n```')
+        else:
+            await ctx.send('**:warning: No metrics have been recorded yet**')
+
+
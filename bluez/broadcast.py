@@ -0,0 +1,230 @@
+# Sharing one ffmpeg process and Opus encoder between every guild playing the same thing
+
+import discord
+import collections
+import threading
+import time
+import os
+
+from bluez.audio import *
+from bluez.metrics import *
+
+
+BLUEZ_BROADCAST = bool(int(os.getenv('BLUEZ_BROADCAST', '0')))
+
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000 # seconds of audio per frame
+BROADCAST_HISTORY = 500 # how many frames to keep behind the furthest-ahead reader, for late joiners
+
+
+
+
+class Broadcast(object):
+
+    # Reads frames from an audio source on a background thread, encodes them as Opus
+    # (if they aren't already), and keeps them so that any number of BroadcastReaders
+    # can play them. The source is read no further ahead of the furthest-ahead reader
+    # than a BufferedSource would read ahead of its voice client, and frames are kept
+    # for a while after that reader has played them so that another guild starting the
+    # same song shortly afterwards can catch up from the beginning.
+
+    def __init__(self, key, original, start_pos=0, live=False, maxframes=READAHEAD_FRAMES, startup_metric='startup'):
+        self.key = key
+        self.original = original
+        self.start_pos = start_pos # the position in the song of the first frame, in seconds
+        self.live = live
+        self.maxframes = maxframes
+        self.startup_metric = startup_metric
+        self.created = time.monotonic()
+        self.frames = collections.deque()
+        self.base = 0 # the index of self.frames[0]
+        self.condition = threading.Condition()
+        self.readers = []
+        self.eof = False
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._fill, name=f'audio-broadcast:{id(self):#x}', daemon=True)
+        self.thread.start()
+
+    @property
+    def produced(self):
+        # the index of the next frame to be read from the source
+        return self.base + len(self.frames)
+
+    def leader(self):
+        # the index of the frame the furthest-ahead reader will play next
+        return max([reader.index for reader in self.readers], default=self.base)
+
+    def _fill(self):
+        # Keep reading frames until the source runs out or everyone has stopped listening
+        encoder = None
+        try:
+            if not self.original.is_opus():
+                encoder = discord.opus.Encoder()
+            data = self.original.read()
+            if data:
+                metrics.sample(self.startup_metric, time.monotonic() - self.created)
+            while True:
+                if data and (encoder is not None):
+                    data = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                    metrics.increment('broadcast_frames_encoded')
+                with self.condition:
+                    if self.stopped:
+                        return
+                    if not data:
+                        self.eof = True
+                        self.condition.notify_all()
+                        return
+                    self.frames.append(data)
+                    # forget frames that are too far behind for anyone to want them
+                    while self.frames and (self.base < self.leader() - BROADCAST_HISTORY):
+                        self.frames.popleft()
+                        self.base += 1
+                    self.condition.notify_all()
+                    while (self.produced - self.leader() >= self.maxframes) and not self.stopped:
+                        self.condition.wait()
+                data = self.original.read()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def join(self, position):
+        # Add a reader that starts at the given position in the song,
+        # or return None if we can't serve that position
+        with self.condition:
+            if self.stopped or (self.error is not None):
+                return None
+            if self.live:
+                # everybody listens to the same moment of a live stream
+                index = self.leader()
+            else:
+                index = int(round((position - self.start_pos) / FRAME_LENGTH))
+                if not (self.base <= index <= self.produced):
+                    return None
+            reader = BroadcastReader(self, index)
+            self.readers.append(reader)
+            self.condition.notify_all()
+            return reader
+
+    def remove_reader(self, reader):
+        # Stop listening; once nobody is listening, stop reading the source
+        with self.condition:
+            if reader in self.readers:
+                self.readers.remove(reader)
+            self.condition.notify_all()
+            if self.readers or self.stopped:
+                return
+            self.stopped = True
+        forget_broadcast(self)
+        self.original.cleanup()
+
+
+
+
+class BroadcastReader(discord.AudioSource):
+
+    # One voice client's view of a Broadcast. Behaves like a BufferedSource,
+    # so the player can prime it and measure it the same way.
+
+    def __init__(self, broadcast, index):
+        self.broadcast = broadcast
+        self.index = index # the index of the next frame to play
+        self.condition = broadcast.condition
+        self.underruns = 0
+        self.nread = 0
+        self.first_frame_time = None
+        self.eof_time = None
+        self.gap_start = None
+        self.closed = False
+
+    def is_opus(self):
+        return True
+
+    def available(self):
+        # return True if there is something for read() to return without waiting
+        broadcast = self.broadcast
+        return (self.index < broadcast.produced) or broadcast.eof or (broadcast.error is not None)
+
+    def prime(self, nframes, timeout=None):
+        # Wait until the first few frames are ready (this blocks)
+        broadcast = self.broadcast
+        with self.condition:
+            self.condition.wait_for(lambda: (broadcast.produced - self.index >= min(nframes, broadcast.maxframes)) or
+                                    broadcast.eof or (broadcast.error is not None), timeout)
+
+    def read(self):
+        broadcast = self.broadcast
+        with self.condition:
+            if getattr(broadcast.error, 'fatal', False):
+                raise broadcast.error
+            if self.index < broadcast.base:
+                # we fell too far behind (e.g. we were paused), so skip ahead to catch up
+                metrics.increment('broadcast_resyncs')
+                self.index = broadcast.base
+            if not self.available():
+                if self.first_frame_time is None:
+                    self.condition.wait_for(self.available)
+                else:
+                    self.condition.wait_for(self.available, UNDERRUN_TIMEOUT)
+            if self.index < broadcast.produced:
+                data = broadcast.frames[self.index - broadcast.base]
+                self.index += 1
+                self.condition.notify_all()
+            elif broadcast.error is not None:
+                raise broadcast.error
+            elif broadcast.eof:
+                data = b''
+            else:
+                self.underruns += 1
+                metrics.increment('buffer_underruns')
+                return OPUS_SILENCE
+        self.nread += 1
+        if self.first_frame_time is None:
+            self.first_frame_time = time.monotonic()
+            if self.gap_start is not None:
+                metrics.sample('track_gap', self.first_frame_time - self.gap_start)
+        if not data:
+            self.eof_time = time.monotonic()
+        return data
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast.remove_reader(self)
+
+
+
+
+# The broadcasts that are currently running, by key
+broadcasts = {}
+broadcasts_lock = threading.Lock()
+
+
+def join_broadcast(key, position):
+    # Get a reader for a running broadcast with the given key that can start
+    # at the given position, or None if there isn't one
+    with broadcasts_lock:
+        broadcast = broadcasts.get(key)
+        reader = (broadcast.join(position) if (broadcast is not None) else None)
+    if reader is not None:
+        metrics.increment('broadcast_joins')
+    return reader
+
+
+def start_broadcast(key, original, position=0, live=False, startup_metric='startup'):
+    # Start broadcasting an audio source, and return the first reader for it.
+    # If there is already a broadcast with this key, it carries on for its
+    # existing readers but new readers will join this one instead.
+    broadcast = Broadcast(key, original, position, live, startup_metric=startup_metric)
+    reader = broadcast.join(position)
+    with broadcasts_lock:
+        broadcasts[key] = broadcast
+        metrics.set('broadcasts', len(broadcasts))
+    return reader
+
+
+def forget_broadcast(broadcast):
+    with broadcasts_lock:
+        if broadcasts.get(broadcast.key) is broadcast:
+            del broadcasts[broadcast.key]
+        metrics.set('broadcasts', len(broadcasts))
@@ -0,0 +1,119 @@
+# Background downloads of songs, which can be played while they are still downloading
+
+import yt_dlp
+import asyncio
+import os
+import logging
+
+from bluez.metrics import *
+from bluez.storage import *
+
+
+
+
+class Download(object):
+
+    # A file that youtube-dl is downloading in the background. The bytes at the start of
+    # the file can be read before the download has finished: youtube-dl writes it to
+    # path + '.part' in order and renames it once it is complete.
+
+    def __init__(self, path):
+        self.path = path
+        self.total = None # the size of the whole file, once youtube-dl knows it
+        self.downloaded = 0
+        self.done = False
+        self.error = None
+        self.task = None
+
+    def hook(self, status):
+        # youtube-dl progress hook; this runs on the download thread
+        self.total = status.get('total_bytes') or self.total
+        if status.get('downloaded_bytes') is not None:
+            self.downloaded = status['downloaded_bytes']
+
+    def finished(self):
+        # return True if there will be no more bytes
+        return self.done or (self.error is not None)
+
+    def available(self):
+        # return the number of bytes at the start of the file that can be read
+        if self.done:
+            return os.path.getsize(self.path)
+        return self.downloaded
+
+    def read(self, start, size):
+        # Read some bytes of the file, wherever it currently is (this blocks)
+        for path in (self.path + '.part', self.path):
+            try:
+                with open(path, 'rb') as o:
+                    o.seek(start)
+                    return o.read(size)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(self.path)
+
+
+
+
+class Downloader(object):
+
+    # Keeps track of the files being downloaded, so that each one is only downloaded once
+    # however many songs refer to it
+
+    def __init__(self):
+        self.downloads = {} # path -> Download
+
+
+    def get(self, path):
+        return self.downloads.get(path)
+
+
+    def start(self, ydl, data):
+        # Start downloading a song in the background if it isn't on disk already,
+        # and return the Download, or None if there is nothing to wait for
+        path = ydl.prepare_filename(data)
+        download = self.downloads.get(path)
+        if (download is not None) and (download.error is None) and not (download.done and not os.path.exists(download.path)):
+            return download # still downloading, or finished and still there
+        if os.path.exists(path):
+            storage.touch(path)
+            return None
+        download = Download(path)
+        self.downloads[path] = download
+        download.task = asyncio.create_task(self.download(download, ydl.params, data))
+        return download
+
+
+    async def download(self, download, params, data):
+        # Fetch a file from the bucket if it is there, or else download it
+        track = track_id(data)
+        if (await storage.fetch(track, download)):
+            self.downloads[download.path] = download
+            download.done = True
+            storage.evict()
+            return
+        # use a separate youtube-dl object so that it reports its progress to us
+        params = dict(params, progress_hooks=[download.hook], noprogress=True,
+                      fixup='never') # fixing up the file afterwards would move bytes someone may be reading
+        ydl = yt_dlp.YoutubeDL(params)
+        loop = asyncio.get_event_loop()
+        metrics.increment('downloads_started')
+        try:
+            info = (await loop.run_in_executor(None, lambda: ydl.process_ie_result(dict(data), download=True)))
+            path = info['requested_downloads'][0]['filepath']
+            if path != download.path:
+                # the file ended up somewhere else (e.g. with another extension)
+                download.path = path
+                self.downloads[path] = download
+            download.done = True
+            storage.upload(track, path)
+            storage.evict()
+        except Exception as e:
+            logging.warning(f'unable to download {download.path}: {e}')
+            download.error = e
+            metrics.increment('downloads_failed')
+
+
+
+
+downloader = Downloader()
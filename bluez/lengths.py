@@ -0,0 +1,74 @@
+# Filling in the lengths of queued songs that arrived without one
+
+import asyncio
+import heapq
+import itertools
+import os
+import logging
+
+from bluez.metrics import *
+
+
+BLUEZ_LENGTH_WORKERS = int(os.getenv('BLUEZ_LENGTH_WORKERS', '4')) # songs to look up at once
+BLUEZ_LENGTH_MAX_SONGS = int(os.getenv('BLUEZ_LENGTH_MAX_SONGS', '200')) # songs to look up from any one playlist
+
+
+
+
+class LengthProber(object):
+
+    # Songs from some playlists (e.g. SoundCloud ones, or flat YouTube ones) don't come with
+    # a length, so the queue's total and the estimated time until a song plays are wrong
+    # until each one reaches the front of the queue. This looks them up in the background,
+    # a few at a time, starting with whichever songs are nearest the front of their queue.
+    # Every lookup is a full youtube-dl extraction, so only the first few hundred songs of
+    # a playlist are looked up; the rest are found out when they are played, as before.
+
+    def __init__(self, workers=BLUEZ_LENGTH_WORKERS, max_songs=BLUEZ_LENGTH_MAX_SONGS):
+        self.workers = workers
+        self.max_songs = max_songs
+        self.heap = [] # (position in queue, sequence number, song, callback)
+        self.counter = itertools.count()
+        self.tasks = set()
+
+
+    def submit(self, songs, position=0, callback=None):
+        # Queue up the songs without lengths, where the first song is at the given position
+        # in its queue. callback(song) is called for each song once its length is known.
+        count = 0
+        for i, song in enumerate(songs):
+            if count >= self.max_songs:
+                break
+            if self.needs_length(song):
+                heapq.heappush(self.heap, (position + i, next(self.counter), song, callback))
+                count += 1
+        while self.heap and (len(self.tasks) < self.workers):
+            task = asyncio.create_task(self.worker())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        metrics.set('length_queue', len(self.heap))
+
+
+    def needs_length(self, song):
+        return not (song.length or song.error or song.dropped or song.data.get('is_live'))
+
+
+    async def worker(self):
+        while self.heap:
+            position, seq, song, callback = heapq.heappop(self.heap)
+            metrics.set('length_queue', len(self.heap))
+            if not self.needs_length(song):
+                continue # found out some other way in the meantime
+            try:
+                await song.fetch_length()
+            except Exception as e:
+                logging.warning(f'unable to get the length of "{song.name}": {e!r}')
+                continue
+            metrics.increment('lengths_probed')
+            if song.length and (callback is not None):
+                callback(song)
+
+
+
+
+lengths = LengthProber()
@@ -0,0 +1,299 @@
+# Local music library, which can be searched and played without youtube-dl
+
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+import logging
+
+import tinytag
+
+from bluez.metrics import *
+
+
+BLUEZ_SETTINGS_PATH = os.getenv('BLUEZ_SETTINGS_PATH')
+BLUEZ_LIBRARY_PATHS = [path for path in os.getenv('BLUEZ_LIBRARY_PATHS', '').split(os.pathsep) if path]
+BLUEZ_LIBRARY_INDEX = os.getenv('BLUEZ_LIBRARY_INDEX') or \
+                      (os.path.join(BLUEZ_SETTINGS_PATH, 'bluez_library.json') if BLUEZ_SETTINGS_PATH else None)
+BLUEZ_LIBRARY_WORKERS = int(os.getenv('BLUEZ_LIBRARY_WORKERS', '4'))
+BLUEZ_LIBRARY_MIN_SCORE = float(os.getenv('BLUEZ_LIBRARY_MIN_SCORE', '0.75')) # see Library.score()
+
+LIBRARY_RESCAN_INTERVAL = 600 # seconds between scans of the library directories for changes
+LIBRARY_EXTENSIONS = ('.mp3', '.m4a', '.mp4', '.ogg', '.oga', '.opus', '.flac', '.wav', '.aac', '.wma', '.aiff', '.aif')
+LIBRARY_SAVE_BATCH = 500 # save the index after reading this many new files, so a long first scan isn't lost
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+
+
+def tokenize(text):
+    # Split some text into lower-case words without accents, for searching
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_RE.findall(text)
+
+
+def read_tags(path):
+    # Read the tags of a file (this blocks, so it runs in the worker pool)
+    try:
+        tag = tinytag.TinyTag.get(path, tags=True, duration=True)
+    except Exception as e:
+        logging.warning(f'unable to read tags from {path}: {e}')
+        return {}
+    return {'title': tag.title, 'artist': tag.artist, 'album': tag.album,
+            'duration': tag.duration, 'asr': tag.samplerate}
+
+
+
+
+class Library(object):
+
+    # An index of the audio files in some local directories. The index is kept in a JSON file
+    # (path -> size, modification time and tags), so after a restart only the files that have
+    # changed need their tags read again. For searching, every word in a file's title, artist,
+    # album and name is mapped to the files containing it, and the words are kept sorted so
+    # that all the words starting with a prefix can be found by bisection.
+
+    def __init__(self, paths=BLUEZ_LIBRARY_PATHS, index_path=BLUEZ_LIBRARY_INDEX, workers=BLUEZ_LIBRARY_WORKERS):
+        self.paths = paths
+        self.index_path = index_path
+        self.workers = workers
+        self.entries = None # path -> dict, loaded on first use
+        self.postings = collections.defaultdict(set) # word -> set of paths
+        self.words = [] # the keys of self.postings, sorted
+        self.pool = None
+        self.task = None
+        self.scanned = None # an event set once the first scan has finished
+
+    @property
+    def enabled(self):
+        return bool(self.paths)
+
+
+    def start(self):
+        # Load the index and start scanning the directories in the background
+        if self.enabled and (self.task is None):
+            self.load()
+            self.scanned = asyncio.Event()
+            self.task = asyncio.create_task(self.rescan_loop())
+
+
+
+    def load(self):
+        # Load the index file if we haven't yet
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if self.index_path and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as o:
+                    self.entries.update(json.load(o))
+            except (IOError, ValueError) as e:
+                logging.warning(f'error loading library index: {e}')
+        for path, entry in self.entries.items():
+            self.add_words(path, entry)
+        metrics.set('library_tracks', len(self.entries))
+
+
+    def save(self):
+        # Write the index file
+        if not self.index_path:
+            return False
+        temp = self.index_path + '.tmp'
+        try:
+            with open(temp, 'w') as o:
+                json.dump(self.entries, o)
+            os.replace(temp, self.index_path)
+            return True
+        except IOError as e:
+            logging.warning(f'error writing library index: {e}')
+            return False
+
+
+
+    def get_words(self, path, entry):
+        # Get the set of searchable words for a file
+        words = set()
+        for field in ('title', 'artist', 'album'):
+            words.update(tokenize(entry.get(field)))
+        words.update(tokenize(os.path.splitext(os.path.basename(path))[0]))
+        return words
+
+
+    def add_words(self, path, entry):
+        for word in self.get_words(path, entry):
+            if word not in self.postings:
+                bisect.insort(self.words, word)
+            self.postings[word].add(path)
+
+
+    def remove_words(self, path, entry):
+        for word in self.get_words(path, entry):
+            paths = self.postings.get(word)
+            if paths is None:
+                continue
+            paths.discard(path)
+            if not paths:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+
+
+    def walk(self):
+        # List the audio files in the library directories, as a dict path -> (size, mtime) (this blocks)
+        files = {}
+        for root in self.paths:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    if filename.lower().endswith(LIBRARY_EXTENSIONS):
+                        path = os.path.abspath(os.path.join(dirpath, filename))
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        files[path] = (stat.st_size, stat.st_mtime)
+        return files
+
+
+    async def scan(self):
+        # Bring the index up to date with the files on disk, only reading the tags of new or changed files
+        self.load()
+        loop = asyncio.get_event_loop()
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='library')
+        started = time.monotonic()
+        files = (await loop.run_in_executor(None, self.walk))
+        changed = False
+        for path in [path for path in self.entries if path not in files]:
+            self.remove_words(path, self.entries.pop(path))
+            changed = True
+        todo = [path for path, (size, mtime) in files.items()
+                if (path not in self.entries) or
+                ((self.entries[path].get('size'), self.entries[path].get('mtime')) != (size, mtime))]
+        for i in range(0, len(todo), LIBRARY_SAVE_BATCH):
+            batch = todo[i:i+LIBRARY_SAVE_BATCH]
+            tags = (await asyncio.gather(*[loop.run_in_executor(self.pool, read_tags, path) for path in batch]))
+            for path, fields in zip(batch, tags):
+                if path in self.entries:
+                    self.remove_words(path, self.entries[path])
+                size, mtime = files[path]
+                entry = dict(fields, size=size, mtime=mtime)
+                self.entries[path] = entry
+                self.add_words(path, entry)
+            metrics.set('library_tracks', len(self.entries))
+            await loop.run_in_executor(None, self.save)
+            changed = False
+        if changed:
+            await loop.run_in_executor(None, self.save)
+        metrics.set('library_tracks', len(self.entries))
+        metrics.sample('library_scan', time.monotonic() - started)
+
+
+    async def rescan_loop(self):
+        while True:
+            try:
+                await self.scan()
+            except Exception as e:
+                logging.warning(f'error scanning library: {e}')
+            self.scanned.set()
+            await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+
+
+
+    def search(self, query, limit=10):
+        # Find the files matching every word of a query, where the last word may be
+        # just the start of a word. Returns a list of paths, best matches first.
+        if not self.enabled:
+            return []
+        self.load()
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        results = None
+        for i, token in enumerate(tokens):
+            if i == len(tokens) - 1:
+                paths = set()
+                j = bisect.bisect_left(self.words, token)
+                while (j < len(self.words)) and self.words[j].startswith(token):
+                    paths.update(self.postings[self.words[j]])
+                    j += 1
+            else:
+                paths = self.postings.get(token, set())
+            results = (paths if results is None else (results & paths))
+            if not results:
+                return []
+        def rank(path):
+            # prefer files where the words are in the title or artist, then shorter titles
+            entry = self.entries[path]
+            words = set(tokenize(entry.get('title'))) | set(tokenize(entry.get('artist')))
+            return (-sum(token in words for token in tokens), len(entry.get('title') or path), path)
+        return sorted(results, key=rank)[:limit]
+
+
+    def score(self, query, path):
+        # How well a query names a file, from 0 to 1: the fraction of the words of its title
+        # that are in the query, or 0 if the query has any words not in its title or artist.
+        # (The last word may be just the start of a word, if it is at least 3 letters long.)
+        entry = self.entries[path]
+        tokens = tokenize(query)
+        title = set(tokenize(entry.get('title') or os.path.splitext(os.path.basename(path))[0]))
+        words = title | set(tokenize(entry.get('artist')))
+        if not (tokens and title):
+            return 0
+        def matches(token, word, last):
+            return (token == word) or (last and (len(token) >= 3) and word.startswith(token))
+        for i, token in enumerate(tokens):
+            if not any(matches(token, word, i == len(tokens) - 1) for word in words):
+                return 0
+        named = [word for word in title if any(matches(token, word, i == len(tokens) - 1)
+                                               for i, token in enumerate(tokens))]
+        return len(named) / len(title)
+
+
+    def best_match(self, query, min_score=BLUEZ_LIBRARY_MIN_SCORE):
+        # Find the file a query names, if any names it closely enough to play it rather than
+        # searching online (so that e.g. "love" doesn't play any file with "love" in it)
+        best = None
+        best_score = min_score
+        for path in self.search(query):
+            score = self.score(query, path)
+            if score >= best_score:
+                best = path
+                best_score = score
+                if score == 1:
+                    break
+        return best
+
+
+    def info(self, path):
+        # Get a youtube-dl style info dict for a file in the library, for creating a Song
+        entry = self.entries[path]
+        title = entry.get('title') or os.path.splitext(os.path.basename(path))[0]
+        if entry.get('artist') and entry.get('title'):
+            title = f'{entry["artist"]} - {title}'
+        return {'_type': 'video',
+                'id': hashlib.sha1(path.encode('utf-8')).hexdigest(),
+                'extractor_key': 'Library',
+                'title': title,
+                'duration': entry.get('duration'),
+                'artist': entry.get('artist'),
+                'track': entry.get('title'),
+                'asr': entry.get('asr'),
+                'url': path,
+                'protocol': 'file',
+                'ext': os.path.splitext(path)[1].lstrip('.').lower(),
+                'requested_downloads': [{'filepath': path}]} # so that it is never downloaded
+
+
+
+
+library = Library()
@@ -0,0 +1,66 @@
+# Process-wide performance metrics
+
+import collections
+import threading
+
+MAX_SAMPLES = 1000 # the number of recent samples to keep for each timing metric
+
+
+
+
+class Metrics(object):
+
+    # Counters, gauges and timing samples shared by every player.
+    # These may be updated from the audio threads as well as the event loop.
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.samples = {}
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def sample(self, name, value):
+        # record a timing sample, in seconds
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.max_samples)
+            self.samples[name].append(value)
+
+    def summary(self, name):
+        # return a tuple (count, mean, median, maximum) for the recent samples of a timing metric
+        with self.lock:
+            values = sorted(self.samples.get(name, ()))
+        if not values:
+            return (0, None, None, None)
+        return (len(values), sum(values) / len(values), values[len(values) // 2], values[-1])
+
+    def report(self):
+        # return a human-readable summary of all the metrics
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            names = sorted(self.samples)
+        for name, value in counters:
+            lines.append(f'{name}: {value}')
+        for name, value in gauges:
+            lines.append(f'{name}: {value:.3g}' if isinstance(value, float) else f'{name}: {value}')
+        for name in names:
+            count, mean, median, maximum = self.summary(name)
+            if count:
+                lines.append(f'{name}: n={count} mean={1000*mean:.1f}ms median={1000*median:.1f}ms max={1000*maximum:.1f}ms')
+        return '\n'.join(lines)
+
+
+
+
+metrics = Metrics()
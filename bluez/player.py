@@ -3,15 +3,16 @@
 import discord
 import asyncio
 import os
-import random
 import collections
 import math
 import time
 import datetime
 import logging
-import tempfile
 
+from bluez.admission import *
+from bluez.lengths import *
 from bluez.song import *
+from bluez.songqueue import *
 from bluez.views import *
 from bluez.util import *
 
@@ -20,6 +21,10 @@ BLUEZ_SETTINGS_PATH = os.getenv('BLUEZ_SETTINGS_PATH')
 BLUEZ_DOWNLOAD_PATH = os.getenv('BLUEZ_DOWNLOAD_PATH')
 
 MAX_HISTORY_LEN = 100
+PREFETCH_TIME = 10 # how many seconds before the end of a song to prepare the audio for the next one
+PRIME_FRAMES = 5 # how many frames of the next song's audio to read ahead of time
+RESTART_DELAY = 0.25 # seconds to wait before restarting ffmpeg for an audio effect, so several changes only restart it once
+ADMISSION_TIMEOUT = 30 # seconds to wait for permission to start ffmpeg before giving up
 
 Lock = DebugLock if BLUEZ_DEBUG else asyncio.Lock
 
@@ -32,9 +37,11 @@ class Player(object):
     def __init__(self, bot, guild):
         self.bot = bot
         self.guild = guild
-        self.queue = collections.deque()
+        self.queue = SongQueue()
         self.history = collections.deque(maxlen=MAX_HISTORY_LEN)
         self.current_history = collections.deque(maxlen=MAX_HISTORY_LEN)
+        self.prefetch_task = None
+        self.prefetched = None
         self.reset_settings()
         self.reset()
         if not self.load_settings():
@@ -71,7 +78,7 @@ class Player(object):
 
 
     def clear_downloads(self):
-        if BLUEZ_DOWNLOAD_PATH:
+        if BLUEZ_DOWNLOAD_PATH and not storage.keeps_files:
             try:
                 for filename in os.listdir(BLUEZ_DOWNLOAD_PATH):
                     os.remove(os.path.join(BLUEZ_DOWNLOAD_PATH, filename))
@@ -84,7 +91,9 @@ class Player(object):
         self.voice_channel = None
         self.voice_client = None
         self.now_playing = None
+        dropped = tuple(self.queue)
         self.queue.clear()
+        self.drop_songs(dropped)
         self.current_history.clear()
         self.queue_end = 0
         self.looping = False
@@ -97,7 +106,11 @@ class Player(object):
         self.last_started_playing = None
         self.last_paused = None
         self.seek_pos = None
-        self.stderr = tempfile.TemporaryFile()
+        self.seek_tempo = None # the tempo self.seek_pos was worked out for, if it was set by update_audio()
+        self.starting = False # True while play_next() is waiting to start ffmpeg without holding the mutex
+        self.source = None
+        self.start_pos = None
+        self.cancel_prefetch()
         self.reset_effects()
         self.clear_downloads()
 
@@ -271,7 +284,6 @@ class Player(object):
                 retrying = False
                 errmsg = None
                 if self.now_playing:
-                    error = (error or get_error(self.stderr))
                     if error:
                         strerror = str(error)
                         if self.should_retry(strerror):
@@ -279,8 +291,13 @@ class Player(object):
                             self.seek_pos = None
                             retrying = True
                             await self.now_playing.reload()
-                        elif self.should_ignore(strerror):
-                            logging.warning(strerror)
+                        elif self.should_probe(error):
+                            # ffmpeg choked on the input hints we gave it before playing anything,
+                            # so try again and let it figure out the format of the input itself
+                            logging.warning(f'retrying "{self.now_playing.name}" without input hints: {strerror}')
+                            self.now_playing.probe_hints = False
+                            self.seek_pos = self.start_pos
+                            retrying = True
                         else:
                             if isinstance(error, Exception):
                                 log_exception(error)
@@ -332,15 +349,61 @@ class Player(object):
                 # Fetch the audio for the song and play it
                 if self.now_playing:
                     self.last_started_playing = None
-                    source = (await self.now_playing.get_audio(self.seek_pos or 0, self.tempo, self.pitch, self.bass,
-                                                               self.nightcore, self.slowed, self.volume, self.stderr))
+                    previous = self.source
+                    source = None
+                    if (self.seek_pos is None) and not retrying:
+                        # use the audio we prepared ahead of time, if we guessed the right song
+                        source = self.take_prefetched()
+                    while source is None:
+                        # Don't hold the mutex while we wait to start ffmpeg, so other commands can run in the
+                        # meantime; in particular, further audio effect changes get folded into this restart
+                        # by update_audio() instead of waiting for it to finish and then restarting again
+                        song = self.now_playing
+                        seek_pos = self.seek_pos
+                        if lock:
+                            self.mutex.release()
+                            acquired = False
+                            self.starting = True
+                        try:
+                            if (seek_pos is not None) and (self.seek_tempo is not None) and not retrying:
+                                # an audio effect was changed; give the user a moment to change any others
+                                await asyncio.sleep(RESTART_DELAY)
+                                seek_pos = self.seek_pos
+                            source, effects = (await self.get_audio(song, seek_pos or 0))
+                        finally:
+                            if lock:
+                                await self.mutex.acquire()
+                                acquired = True
+                                self.starting = False
+                        if isinstance(source, Superseded):
+                            # a newer request to play something has taken over
+                            return
+                        if not lock:
+                            break
+                        if (self.voice_client is None) or self.voice_client.is_playing() or self.voice_client.is_paused() \
+                           or (self.now_playing is not song):
+                            # somebody else started playing something, or disconnected the bot, while we were waiting
+                            if not isinstance(source, Exception):
+                                source.cleanup()
+                            return
+                        if (not isinstance(source, Exception)) and ((self.seek_pos != seek_pos) or (effects != self.get_effects())):
+                            # the position or the audio effects changed while ffmpeg was starting, so start it again
+                            source.cleanup()
+                            source = None
                     if isinstance(source, Exception):
                         self.seek_pos = None
+                        self.seek_tempo = None
                         await self.play_next(source, lock=False)
                         return
+                    self.source = source
+                    self.start_pos = self.seek_pos
+                    if (previous is not None) and (self.unwrap(previous).eof_time is not None) and (self.seek_pos is None):
+                        # the previous song ended by itself, so measure how long the transition takes
+                        self.unwrap(source).gap_start = self.unwrap(previous).eof_time
                     self.voice_client.play(source, after=self._play_next_callback)
                     now = time.time()
                     self.last_started_playing = now - (self.seek_pos or 0)
+                    self.schedule_prefetch()
                     if self.last_paused is not None:
                         # The bot will remember if it was paused if you skip, seek, or mess with audio effects.
                         # The only exception is that if you skip past the end of the queue and the bot becomes idle,
@@ -353,6 +416,7 @@ class Player(object):
                         self.current_history.append(entry)
                     announce = (self.announcesongs and (self.seek_pos is None) and not retrying)
                     self.seek_pos = None
+                    self.seek_tempo = None
                     if announce:
                         await self.np_message(self.text_channel)
             else:
@@ -368,7 +432,9 @@ class Player(object):
 
     def _play_next_callback(self, error):
         # Callback for play_next()
-        self._play_next_task = self.bot.loop.create_task(self.play_next(error, lock=True))
+        # This runs on the audio thread, so the event loop has to be woken up explicitly;
+        # otherwise the next song would not start until something else happened on the loop
+        self._play_next_task = asyncio.run_coroutine_threadsafe(self.play_next(error, lock=True), self.bot.loop)
 
 
 
@@ -384,13 +450,16 @@ class Player(object):
             if self.voice_client.is_playing() or self.voice_client.is_paused():
                 self.voice_client.stop()
             else:
+                # if ffmpeg is being restarted for an audio effect, skip the song instead
+                self.seek_pos = None
+                self.seek_tempo = None
                 await self.play_next()
 
 
     async def wake_up(self):
         # Play a song if nothing is currently playing
-        # Do nothing if there's already a song playing
-        if not (self.voice_client.is_playing() or self.voice_client.is_paused()):
+        # Do nothing if there's already a song playing, or about to start
+        if not (self.voice_client.is_playing() or self.voice_client.is_paused() or self.starting):
             await self.play_next()
 
 
@@ -400,7 +469,55 @@ class Player(object):
         if (self.voice_client is not None) and (self.voice_client.is_playing() or self.voice_client.is_paused()):
             self.seek_pos = (self.get_current_time() or 0)
             self.seek_pos *= self.now_playing.tempo / self.get_adjusted_tempo()
+            self.seek_tempo = self.get_adjusted_tempo()
             self.voice_client.stop()
+        elif (self.seek_pos is not None) and (self.seek_tempo is not None):
+            # a restart for an earlier change is on its way and will pick this change up too,
+            # but the position it restarts from has to follow any change in tempo
+            self.seek_pos *= self.seek_tempo / self.get_adjusted_tempo()
+            self.seek_tempo = self.get_adjusted_tempo()
+
+
+    def update_volume(self):
+        # Called when the volume is changed
+        # Scale the samples of the current song if we can, rather than restarting ffmpeg
+        if isinstance(self.source, VolumeTransformer) and self.source.set_volume(self.volume):
+            return
+        self.update_audio()
+
+
+    def get_effects(self):
+        # Get the audio effect parameters to pass to Song.get_audio()
+        return (self.tempo, self.pitch, self.bass, self.nightcore, self.slowed, self.volume)
+
+
+    async def get_audio(self, song, seek_pos=0, priority=PRIORITY_PLAY):
+        # Get the audio for a song, once the admission controller lets us start ffmpeg.
+        # Returns a tuple (source, effects), where source may be an exception.
+        try:
+            ticket = (await admission.acquire(self.guild.id, key=(self.guild.id, priority), priority=priority,
+                                              timeout=ADMISSION_TIMEOUT))
+        except Superseded as e:
+            return e, None
+        except asyncio.TimeoutError:
+            return Exception('the bot is too busy to play anything right now, please try again later'), None
+        # read the effects only now, in case they were changed while we were waiting
+        effects = self.get_effects()
+        try:
+            source = (await song.get_audio(seek_pos, *effects, bitrate=self.get_bitrate(), ticket=ticket))
+        except BaseException:
+            # e.g. resolving the song failed, or we were cancelled; either way no source owns the ticket
+            ticket.release()
+            raise
+        if isinstance(source, Exception):
+            ticket.release()
+        return source, effects
+
+
+    def get_bitrate(self):
+        # Get the bitrate of the voice channel in kbps, which downloaded songs are transcoded to
+        if self.voice_channel is not None:
+            return self.voice_channel.bitrate // 1000
 
 
     def get_current_time(self):
@@ -417,25 +534,93 @@ class Player(object):
         return get_adjusted_tempo(self.tempo, self.nightcore, self.slowed)
 
 
+    def peek_next(self):
+        # Get the song that will play next once the current song ends by itself,
+        # assuming nobody changes the queue in the meantime
+        if self.looping:
+            return self.now_playing
+        elif self.queue:
+            return self.queue[0]
+
+
+    def schedule_prefetch(self):
+        # Arrange for the audio of the next song to be prepared shortly before the current song ends
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        if self.now_playing and self.now_playing.adjusted_length:
+            delay = self.now_playing.adjusted_length - (self.get_current_time() or 0) - PREFETCH_TIME
+            self.prefetch_task = asyncio.create_task(self.prefetch_next(max(delay, 0)))
+
+
+    async def prefetch_next(self, delay):
+        # Start the ffmpeg process for the next song and read its first few frames,
+        # so that play_next() can start it with no gap after the current song ends
+        await asyncio.sleep(delay)
+        # past this point the task is no longer cancelled, so that the source is never lost
+        self.prefetch_task = None
+        song = self.peek_next()
+        if song is None:
+            return
+        effects = self.get_effects()
+        if self.prefetched:
+            if (self.prefetched[0] is song) and (self.prefetched[1] == effects):
+                return # already done
+            self.discard_prefetched()
+        source, effects = (await self.get_audio(song, 0, PRIORITY_PREFETCH))
+        if isinstance(source, Exception):
+            return # play_next() will try again and report the error
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, lambda: self.unwrap(source).prime(PRIME_FRAMES, PREFETCH_TIME))
+        if (self.voice_client is None) or self.prefetched:
+            # we disconnected (or somebody else prefetched) in the meantime
+            source.cleanup()
+        else:
+            self.prefetched = (song, effects, source)
+
+
+    def unwrap(self, source):
+        # Get the buffered source (or broadcast reader) underneath any volume transformer
+        while not isinstance(source, (BufferedSource, BroadcastReader)):
+            source = source.original
+        return source
+
+
+    def take_prefetched(self):
+        # Return the prefetched audio source if it matches the song and effects we are about to play
+        if self.prefetched:
+            song, effects, source = self.prefetched
+            self.prefetched = None
+            if (song is self.now_playing) and (effects == self.get_effects()):
+                return source
+            source.cleanup()
+
+
+    def discard_prefetched(self):
+        if self.prefetched:
+            self.prefetched[2].cleanup()
+            self.prefetched = None
+
+
+    def cancel_prefetch(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        self.discard_prefetched()
+
+
+    def should_probe(self, error):
+        # Determine if an error happened because ffmpeg could not use the input hints for the current song
+        return isinstance(error, FFmpegError) and self.now_playing.hinted and (self.source is not None) and \
+               (self.unwrap(self.source).nread == 0)
+
+
     def should_retry(self, errmsg):
         # Determine from the text of an error message if we should reload the song and try again
         return False
         #return 'Server returned 403 Forbidden (access denied)' in errmsg # try again for this stupid bug
 
 
-    def should_ignore(self, errmsg):
-        # Determine from the text of an error message if we should ignore it without printing anything out
-        if 'Connection reset by peer' in errmsg:
-            return True # these are not worth complaining about
-        if 'Estimating duration from bitrate' in errmsg:
-            return True # this is a warning, not an error
-        if 'Output file is empty, nothing was encoded' in errmsg:
-            return True # the user messed with the audio effects for a song right as it was ending
-        if 'Error in the pull function' in errmsg:
-            return True # these are not worth complaining about either
-        return False
-
-
 
 
 
@@ -469,61 +654,61 @@ class Player(object):
 
 
     async def queue_message(self, ctx, start_index=0):
-        # Post the queue to the appropriate channel
-        n = len(self.queue)
+        # Post the queue to the appropriate channel. Each page is only made when someone
+        # looks at it, from a snapshot of the queue as it is now.
+        queue = self.queue.snapshot()
+        n = len(queue)
         npages = (n - 1) // 10 + 1
-        total = format_time(sum([i.length for i in self.queue]) / self.get_adjusted_tempo())
-        embeds = []
+        tempo = self.get_adjusted_tempo()
+        total = format_time(self.queue.total_length() / tempo)
+        now_playing = self.now_playing
+        queue_end = self.queue_end
+        footer = ' | Loop: ' + ('\u2705' if self.looping else '\u274c') + ' | '
+        footer += 'Queue Loop: ' + ('\u2705' if self.queue_looping else '\u274c')
         color = discord.Color.random()
-        for i in range(npages):
+        def render(i):
             embed = discord.Embed(title=f'Queue for {ctx.guild.name}', color=color)
             description = ''
             if i == 0:
-                if self.now_playing:
-                    description += f'__Now Playing:__\n{format_link(self.now_playing)} | '
-                    description += f'`{format_time(self.now_playing.adjusted_length)} Requested by {format_user(self.now_playing.user)}`\n\n'
+                if now_playing:
+                    description += f'__Now Playing:__\n{format_link(now_playing)} | '
+                    description += f'`{format_time(now_playing.adjusted_length)} Requested by {format_user(now_playing.user)}`\n\n'
                 description += '__Up Next:__\n'
-            for j, song in enumerate(tuple(self.queue)[10*i : 10*(i+1)], 10*i+1):
-                if j == self.queue_end + 1:
+            for j, song in enumerate(queue.range(10*i, 10*(i+1)), 10*i+1):
+                if j == queue_end + 1:
                     description += '\u25ac' * 20 + '\n\n'
                 description += f'`{j}.` {format_link(song)} | '
-                description += f'`{format_time(song.length / self.get_adjusted_tempo())} Requested by {format_user(song.user)}`\n\n'
+                description += f'`{format_time(song.length / tempo)} Requested by {format_user(song.user)}`\n\n'
             description += f'**{n} songs in queue | {total} total length**\n\n'
             embed.description = description
-            footer = f'Page {i+1}/{npages} | '
-            footer += 'Loop: ' + ('\u2705' if self.looping else '\u274c') + ' | '
-            footer += 'Queue Loop: ' + ('\u2705' if self.queue_looping else '\u274c')
-            embed.set_footer(text=footer, icon_url=ctx.author.avatar.url)
-            embeds.append(embed)
-        await post_multipage_embed(ctx, embeds, start_index)
+            embed.set_footer(text=f'Page {i+1}/{npages}' + footer, icon_url=ctx.author.avatar.url)
+            return embed
+        await post_multipage_embed(ctx, LazyPages(npages, render), start_index)
 
 
 
     async def history_message(self, ctx, timezone=None):
-        # Post the history to the appropriate channel
-        n = len(self.history)
+        # Post the history to the appropriate channel, newest page last.
+        # Each page is only made when someone looks at it.
+        history = tuple(self.history)
+        n = len(history)
         npages = (n - 1) // 10 + 1
-        embeds = []
         color = discord.Color.random()
         if timezone:
             tzname = datetime.datetime.utcnow().astimezone(timezone).tzname()
         else:
             tzname = 'UTC'
-        for i in range(npages):
+        def render(page):
+            i = npages - 1 - page # pages are counted back from the newest
             embed = discord.Embed(title=f'History for {ctx.guild.name} (`{tzname}` time zone)', color=color)
             description = ''
-            for song, timestamp in tuple(self.history)[-10*(i+1) : ((-10*i) or None)]:
-                if timezone:
-                    timestamp = timestamp.astimezone(timezone)
-                strftime = timestamp.strftime('%x %X')
-                description += f'`{strftime}` {format_link(song)} | `Requested by {format_user(song.user)}`\n\n'
+            for song, timestamp in history[max(n - 10*(i+1), 0) : n - 10*i]:
+                description += f'`{format_timestamp(timestamp, timezone)}` {format_link(song)} | `Requested by {format_user(song.user)}`\n\n'
             embed.description = description
-            footer = f'Page {npages-i}/{npages}'
-            embed.set_footer(text=footer,
+            embed.set_footer(text=f'Page {page+1}/{npages}',
                              icon_url=ctx.author.avatar.url)
-            embeds.append(embed)
-        embeds.reverse()
-        await post_multipage_embed(ctx, embeds, npages-1)
+            return embed
+        await post_multipage_embed(ctx, LazyPages(npages, render), npages-1)
 
 
 
@@ -545,7 +730,7 @@ class Player(object):
         else:
             # Add songs to the end of the queue
             # and estimate how long it will be until they are played
-            time = sum([i.length for i in tuple(self.queue)[:position]]) / self.get_adjusted_tempo()
+            time = self.queue.length_before(position) / self.get_adjusted_tempo()
             if self.now_playing is not None:
                 time += max(self.now_playing.adjusted_length - (self.get_current_time() or 0), 0)
             if time == 0:
@@ -616,6 +801,11 @@ class Player(object):
         # which can be either a URL or a search term
         if is_url(query):
             return (await self.songs_from_url(ctx, query, where, priority))
+        # the library stands in for the default source only, so that asking for e.g. SoundCloud gets SoundCloud
+        songs = (songs_from_library(query, ctx.author) if (source == tuple(SEARCH_INFO)[0]) else [])
+        if songs:
+            await ctx.send(f'**:file_folder: Found `{query}` in the library**')
+            return (await self.trim_songs(ctx, songs, where, priority))
         search_key, emoji = SEARCH_INFO[source][:2]
         await ctx.send(f'**{emoji} Searching :mag: `{query}`**')
         try:
@@ -707,7 +897,7 @@ class Player(object):
                     await ctx.send('**:warning: Shortening playlist due to reaching the song queue limit**')
         # If self.maxusersongs is not None, this removes any songs queued by this user that exceed the limit
         if (self.maxusersongs > 0) and (not anonymous):
-            nuser = len([song for song in self.queue if song.user == songs[0].user])
+            nuser = self.queue.count_user(songs[0].user)
             if nuser >= self.maxusersongs:
                 await ctx.send('**:x: Unable to queue song, you have reached the maximum songs you can have in the queue**')
                 return []
@@ -729,20 +919,42 @@ class Player(object):
                 cutoff = 0
             # Split the queue into "songs that will play before these songs play" and "songs that will play after".
             # If we're shuffling, the entire queue is considered "before" -- it doesn't make any difference in this case.
-            pre_queue = tuple(self.queue)[:cutoff]
-            post_queue = tuple(self.queue)[cutoff:]
-            orig_songs = songs.copy()
-            for i, song in enumerate(orig_songs):
-                # If the song is already on the queue ahead of where we're going to insert it,
-                # or if it appears more than once in the playlist, just throw it out of the playlist.
-                if (song in pre_queue) or (song in orig_songs[:i]):
-                    songs.remove(song)
-                    removed.append(song)
-                elif song in post_queue:
+            # Only the smaller part is counted up here; the queue keeps count of all its songs by identity.
+            if cutoff <= len(self.queue) // 2:
+                pre_counts = collections.Counter(song.identity() for song in self.queue[:cutoff])
+                in_pre = lambda song: pre_counts[song.identity()] > 0
+                in_post = lambda song: self.queue.count(song) > pre_counts[song.identity()]
+            else:
+                post_counts = collections.Counter(song.identity() for song in self.queue[cutoff:])
+                in_pre = lambda song: self.queue.count(song) > post_counts[song.identity()]
+                in_post = lambda song: post_counts[song.identity()] > 0
+            # If a song appears more than once in the playlist, only the last copy of it is kept
+            last = {song.identity(): i for i, song in enumerate(songs)}
+            moving = set()
+            kept = []
+            for i, song in enumerate(songs):
+                key = song.identity()
+                if in_post(song) and not (in_pre(song) or (key in moving)):
                     # if we're doing /playtop or /playskip; or if we're doing /play with priority,
                     # move the song forward if it's already in the queue, rather than just leaving it where it is.
-                    self.queue.remove(song)
+                    moving.add(key)
                     moved.append(song)
+                # If the song is already on the queue ahead of where we're going to insert it,
+                # or if it appears again later in the playlist, just throw it out of the playlist.
+                if in_pre(song) or (last[key] != i):
+                    removed.append(song)
+                else:
+                    kept.append(song)
+            songs[:] = kept
+            if moving:
+                # take the first copy of each moved song after the cutoff off the queue
+                positions = []
+                for i, song in enumerate(self.queue[cutoff:], cutoff):
+                    if song.identity() in moving:
+                        positions.append(i)
+                        moving.discard(song.identity())
+                self.remove_positions(positions)
+            self.drop_songs(removed)
             if not anonymous:
                 # Send messages for songs that were removed, and separately for songs that were moved forward.
                 # It is rare, but possible, to get both messages. (For example, if you're using /playtop or /playskip
@@ -775,14 +987,14 @@ class Player(object):
         async with self.mutex:
             if priority:
                 n = self.queue_end
-                for song in songs[::-1]:
-                    self.queue.insert(n, song)
+                self.queue.splice(n, songs)
                 self.queue_end += len(songs)
             else:
                 n = len(self.queue)
                 self.queue.extend(songs)
                 if self.queue_end == n:
                     self.queue_end += len(songs)
+            self.probe_lengths(songs, n)
             await self.enqueue_message(ctx, n, songs)
             await self.wake_up()
 
@@ -790,8 +1002,9 @@ class Player(object):
     async def playtop(self, ctx, songs):
         # Place the songs at the top of the queue
         async with self.mutex:
-            self.queue.extendleft(songs[::-1])
+            self.queue.splice(0, songs)
             self.queue_end += len(songs)
+            self.probe_lengths(songs, 0)
             await self.enqueue_message(ctx, 0, songs)
             await self.wake_up()
 
@@ -799,19 +1012,52 @@ class Player(object):
     async def playskip(self, ctx, songs):
         # Place the songs at the top of the queue and then skip to the next song
         async with self.mutex:
-            self.queue.extendleft(songs[::-1])
+            self.queue.splice(0, songs)
             self.queue_end += len(songs)
+            self.probe_lengths(songs, 0)
             await self.enqueue_message(ctx, 0, songs, now=True)
             await self.skip(ctx)
 
 
+    def drop_songs(self, songs):
+        # Let songs that have been taken off the queue without being played know that
+        # they aren't needed any more (songs that are still on the queue are left alone,
+        # since songs that are equal to each other may have been removed instead)
+        queued = set(map(id, self.queue))
+        for song in songs:
+            if (id(song) not in queued) and (song is not self.now_playing):
+                song.drop()
+
+
+    def remove_positions(self, positions):
+        # Take the songs at some positions off the queue in one pass, keeping the
+        # priority marker in the same place relative to the songs left; returns the songs
+        self.queue_end -= len([i for i in positions if i < self.queue_end])
+        removed = self.queue.delete_positions(positions)
+        self.drop_songs(removed)
+        return removed
+
+
+    def probe_lengths(self, songs, position):
+        # Look up the lengths of any of these songs that came without one in the background,
+        # starting with the ones that will play soonest (the first is at the given position)
+        lengths.submit(songs, position, self.length_found)
+
+
+    def length_found(self, song):
+        # Called when the length of a song in the queue has been looked up
+        if song is self.now_playing:
+            self.schedule_prefetch() # we couldn't tell when it would end before
+
+
     async def playshuffle(self, ctx, songs, priority=False):
         # Place the songs in the queue, then shuffle the queue
         async with self.mutex:
             now = not (self.now_playing or self.queue)
             self.queue.extend(songs)
-            random.shuffle(self.queue)
+            self.queue.shuffle()
             self.queue_end = len(self.queue) if priority else 0
+            self.probe_lengths(songs, 0)
             await self.enqueue_message(ctx, 0, songs, now=now, shuffle=True)
             await self.wake_up()
 
@@ -893,17 +1139,15 @@ class Player(object):
     async def skipto(self, ctx, position):
         # Skip to the song at a specified position in the queue
         async with self.mutex:
-            for n in range(position-1):
-                if self.queue:
-                    song = self.queue.popleft()
-                    if self.queue_looping:
-                        self.queue.append(song)
-                else:
-                    break
+            n = min(position-1, len(self.queue))
+            if n > 0:
+                skipped = self.queue.delete_range(0, n)
+                if self.queue_looping:
+                    self.queue.extend(skipped)
                 if self.queue_end < position:
                     self.queue_end = 0
                 elif not (self.queue_looping and (self.queue_end == len(self.queue))):
-                    self.queue_end -= position - 1
+                    self.queue_end -= n
             await self.skip(ctx)
 
 
@@ -950,7 +1194,7 @@ class Player(object):
     async def shuffle(self, ctx, priority=False):
         # Shuffle the queue
         async with self.mutex:
-            random.shuffle(self.queue)
+            self.queue.shuffle()
             self.queue_end = (len(self.queue) if priority else 0)
             await ctx.send('**:twisted_rightwards_arrows: Shuffled queue :ok_hand:**')
 
@@ -961,8 +1205,7 @@ class Player(object):
             if not ((1 <= old <= len(self.queue)) and (1 <= new <= len(self.queue))):
                 await ctx.send(f'**:x: Invalid position, should be between 1 and {len(self.queue)}**')
             else:
-                song = self.queue[old - 1]
-                del self.queue[old - 1]
+                song = self.queue.pop(old - 1)
                 if new >= old:
                     new += 1
                 self.queue.insert(new - 1, song)
@@ -981,10 +1224,10 @@ class Player(object):
             if not (1 <= position <= len(self.queue)):
                 await ctx.send(f'**:x: Invalid position, should be between 1 and {len(self.queue)}**')
             else:
-                song = self.queue[position - 1]
-                del self.queue[position - 1]
+                song = self.queue.pop(position - 1)
                 if position-1 < self.queue_end:
                     self.queue_end -= 1
+                self.drop_songs([song])
                 await ctx.send(f'**:white_check_mark: Removed `{song.name}`**')
 
 
@@ -999,13 +1242,12 @@ class Player(object):
                 else:
                     await ctx.send(f'**:x: Invalid position, should be between 1 and {len(self.queue)}**')
             else:
-                removed = tuple(self.queue)[start-1 : end]
-                for song in removed:
-                    self.queue.remove(song)
+                removed = self.queue.delete_range(start-1, end)
                 if end-1 < self.queue_end:
                     self.queue_end -= (end - start + 1)
                 elif start-1 < self.queue_end:
                     self.queue_end = start-1
+                self.drop_songs(removed)
                 await ctx.send(f'**:white_check_mark: Removed {len(removed)} song{plural(len(removed))}**')
 
 
@@ -1013,18 +1255,17 @@ class Player(object):
         # Remove all the songs from the queue
         async with self.mutex:
             if user is None:
+                dropped = tuple(self.queue)
                 self.queue.clear()
                 self.queue_end = 0
+                self.drop_songs(dropped)
                 await ctx.send('***:boom: Cleared... :stop_button:***')
             else:
                 # only remove the songs queued up by this particular user
                 n = 0
-                for song in tuple(self.queue):
-                    if song.user == user:
-                        if self.queue.index(song) < self.queue_end:
-                            self.queue_end -= 1
-                        self.queue.remove(song)
-                        n += 1
+                if self.queue.count_user(user):
+                    positions = [i for i, song in enumerate(self.queue) if requester(song) == user.id]
+                    n = len(self.remove_positions(positions))
                 await ctx.send(f'**:thumbsup: {n} song{plural(n)} removed from the queue**')
 
 
@@ -1032,26 +1273,20 @@ class Player(object):
         # Remove all songs queued by absent users
         async with self.mutex:
             n = 0
-            for song in tuple(self.queue):
-                if song.user not in self.voice_channel.members:
-                    if self.queue.index(song) < self.queue_end:
-                        self.queue_end -= 1
-                    self.queue.remove(song)
-                    n += 1
+            present = {member.id for member in self.voice_channel.members}
+            if any(user not in present for user in self.queue.users):
+                positions = [i for i, song in enumerate(self.queue) if requester(song) not in present]
+                n = len(self.remove_positions(positions))
             await ctx.send(f'**:thumbsup: {n} song{plural(n)} removed from the queue**')
 
 
     async def removedupes(self, ctx, quiet=False):
         # Remove all duplicate songs from the queue
         async with self.mutex:
-            t = tuple(self.queue)
-            n = 0
-            for i, song in enumerate(t):
-                if song in t[:i]:
-                    if self.queue.index(song) < self.queue_end:
-                        self.queue_end -= 1
-                    self.queue.remove(song)
-                    n += 1
+            # only the last copy of each song is kept
+            last = {song.identity(): i for i, song in enumerate(self.queue)}
+            positions = [i for i, song in enumerate(self.queue) if last[song.identity()] != i]
+            n = len(self.remove_positions(positions))
             if (n or not quiet):
                 await ctx.send(f'**:thumbsup: {n} song{plural(n)} removed from the queue**')
 
@@ -1175,8 +1410,9 @@ class Player(object):
                 if (self.voice_channel is not None) and (len(self.queue) > length):
                     # if the queue is too full, go ahead and delete the excess songs now
                     n = len(self.queue) - length
-                    self.queue = collections.deque(tuple(self.queue)[:length])
+                    dropped = self.queue.delete_range(length, len(self.queue))
                     self.queue_end = min(self.queue_end, len(self.queue))
+                    self.drop_songs(dropped)
                     await ctx.send(f'**:thumbsup: {n} song{plural(n)} removed from the end of the queue**')
 
 
@@ -1197,15 +1433,15 @@ class Player(object):
                 await ctx.send(f'**:white_check_mark: Max user song limit set to {number}**')
                 if (self.voice_channel is not None) and self.queue:
                     # go ahead and check through the queue now for excess songs
-                    counter = collections.Counter()
                     n = 0
-                    for song in tuple(self.queue):
-                        counter[song.user.id] += 1
-                        if counter[song.user.id] > number:
-                            if self.queue.index(song) < self.queue_end:
-                                self.queue_end -= 1
-                            self.queue.remove(song)
-                            n += 1
+                    if max(self.queue.users.values()) > number:
+                        counter = collections.Counter()
+                        positions = []
+                        for i, song in enumerate(self.queue):
+                            counter[requester(song)] += 1
+                            if counter[requester(song)] > number:
+                                positions.append(i)
+                        n = len(self.remove_positions(positions))
                     if n:
                         await ctx.send(f'**:thumbsup: {n} song{plural(n)} removed from the queue**')
 
@@ -1430,7 +1666,7 @@ class Player(object):
             if self.volume != volume / 200.0:
                 async with self.mutex:
                     self.volume = volume / 200.0
-                    self.update_audio()
+                    self.update_volume()
             await ctx.send(f'**:white_check_mark: Volume set to {volume}**')
 
 
@@ -0,0 +1,307 @@
+# Recognizing links straight to audio files or radio streams, so that they can be played without youtube-dl
+
+import aiohttp
+import asyncio
+import hashlib
+import io
+import os
+import re
+import time
+import urllib.parse
+import logging
+
+import tinytag
+import yt_dlp
+
+from bluez.metrics import *
+
+
+BLUEZ_DIRECT_MEDIA = bool(int(os.getenv('BLUEZ_DIRECT_MEDIA', '1')))
+BLUEZ_PROBE_CONCURRENCY = int(os.getenv('BLUEZ_PROBE_CONCURRENCY', '16')) # probes that may run at once
+
+PROBE_BLOCK_SIZE = 65536 # bytes to fetch at a time for the tag parser
+PROBE_MAX_REQUESTS = 8 # give up on the tags if the parser wants more pieces of the file than this
+PROBE_TIMEOUT = 10 # seconds to spend probing before letting youtube-dl have a go instead
+PROBE_KEEPALIVE = 30 # seconds to keep idle connections open for the next probe
+
+# extensions of links that are surely audio files
+DIRECT_MEDIA_EXTS = ('mp3', 'ogg', 'oga', 'opus', 'flac', 'wav', 'm4a', 'aac', 'mka')
+# content types of responses that are audio, for links that don't say what they are
+DIRECT_MEDIA_TYPES = ('audio/', 'application/ogg')
+# the file extension for each content type, for links without one
+MEDIA_TYPE_EXTS = {
+    'audio/mpeg'      : 'mp3',
+    'audio/mp3'       : 'mp3',
+    'audio/ogg'       : 'ogg',
+    'application/ogg' : 'ogg',
+    'audio/opus'      : 'opus',
+    'audio/flac'      : 'flac',
+    'audio/x-flac'    : 'flac',
+    'audio/wav'       : 'wav',
+    'audio/x-wav'     : 'wav',
+    'audio/mp4'       : 'm4a',
+    'audio/aac'       : 'aac',
+    'audio/aacp'      : 'aac',
+    }
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+
+
+class MissingRange(Exception):
+
+    # Raised by a RangeFile when the parser reads bytes we haven't fetched yet
+
+    def __init__(self, start, end):
+        Exception.__init__(self, f'bytes {start}-{end - 1} have not been fetched')
+        self.start = start
+        self.end = end
+
+
+
+
+class RangeFile(object):
+
+    # A read-only file of a known length of which only some blocks are available.
+    # Reading anything else raises MissingRange, so the caller can fetch it and try again.
+
+    def __init__(self, length, blocks):
+        self.length = length
+        self.blocks = blocks # block index -> bytes
+        self.pos = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = self.length if ((size is None) or (size < 0)) else min(self.pos + size, self.length)
+        if end <= self.pos:
+            return b''
+        first = self.pos // PROBE_BLOCK_SIZE
+        last = (end - 1) // PROBE_BLOCK_SIZE
+        missing = [index for index in range(first, last + 1) if index not in self.blocks]
+        if missing:
+            raise MissingRange(missing[0] * PROBE_BLOCK_SIZE, min((missing[-1] + 1) * PROBE_BLOCK_SIZE, self.length))
+        data = b''.join(self.blocks[index] for index in range(first, last + 1))
+        offset = first * PROBE_BLOCK_SIZE
+        data = data[self.pos - offset:end - offset]
+        self.pos = end
+        return data
+
+    def close(self):
+        pass
+
+
+
+
+def find_missing(error):
+    # Find the MissingRange that caused an exception from the tag parser, if there was one
+    while error is not None:
+        if isinstance(error, MissingRange):
+            return error
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def url_ext(url):
+    return os.path.splitext(urllib.parse.urlparse(url).path)[1].lstrip('.').lower()
+
+
+def has_extractor(url):
+    # Return True if youtube-dl has an extractor for this site, other than the generic one
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if (ie.ie_key() != 'Generic') and ie.suitable(url):
+            return True
+    return False
+
+
+def store_blocks(blocks, start, data, length):
+    # Split bytes that were fetched from some offset into blocks, keeping only
+    # whole blocks (or the last block of the file, which may be shorter)
+    index = -(-start // PROBE_BLOCK_SIZE)
+    while index * PROBE_BLOCK_SIZE < start + len(data):
+        offset = index * PROBE_BLOCK_SIZE - start
+        block = data[offset:offset + PROBE_BLOCK_SIZE]
+        if (len(block) == PROBE_BLOCK_SIZE) or (index * PROBE_BLOCK_SIZE + len(block) == length):
+            blocks[index] = block
+        index += 1
+
+
+
+
+async def read_body(response, size):
+    # Read up to size bytes of a response
+    data = b''
+    while len(data) < size:
+        chunk = (await response.content.read(size - len(data)))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+async def fetch_range(session, url, start, end, headers=None):
+    # Fetch the bytes from start up to (not including) end, or the last -start bytes if start is negative.
+    # Returns a tuple (start, data, total length or None, response); if the server
+    # ignores ranges, this is the start of the file and response.status is 200.
+    value = (f'bytes={start}' if start < 0 else f'bytes={start}-{end - 1}')
+    async with session.get(url, headers=dict(headers or {}, Range=value)) as response:
+        response.raise_for_status()
+        match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        if (response.status == 206) and match:
+            data = (await read_body(response, int(match.group(2)) - int(match.group(1)) + 1))
+            total = (int(match.group(3)) if match.group(3) != '*' else None)
+            return (int(match.group(1)), data, total, response)
+        # the server ignored the range, so just take the start of the file (or stream)
+        return (0, (await read_body(response, PROBE_BLOCK_SIZE)), response.content_length, response)
+
+
+async def fetch_ends(session, url, blocks, headers=None, tail=True):
+    # Fetch the start of a file, and the end too if asked (which is where the duration
+    # or tags are kept in some formats), into blocks. Returns the response for the start.
+    requests = [fetch_range(session, url, 0, PROBE_BLOCK_SIZE, headers)]
+    if tail:
+        requests.append(fetch_range(session, url, -2 * PROBE_BLOCK_SIZE, None, headers))
+    results = (await asyncio.gather(*requests, return_exceptions=True))
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    start, data, total, response = results[0]
+    if total is not None:
+        store_blocks(blocks, 0, data, total)
+        for result in results[1:]:
+            if not isinstance(result, BaseException) and (result[3].status == 206):
+                store_blocks(blocks, result[0], result[1], total)
+    return (total, response)
+
+
+async def read_tags(session, url, total, blocks, ranged=True, headers=None):
+    # Run the tag parser over the blocks we have, fetching whatever else it needs (if we can).
+    # If it keeps reading on from where the last fetch ended, fetch twice as much each time.
+    size = PROBE_BLOCK_SIZE
+    last_end = None
+    for i in range(PROBE_MAX_REQUESTS if ranged else 1):
+        try:
+            return tinytag.TinyTag.get(file_obj=RangeFile(total, blocks), tags=True, duration=True)
+        except Exception as e:
+            missing = find_missing(e)
+            if missing is None:
+                raise
+        size = (size * 2 if missing.start == last_end else PROBE_BLOCK_SIZE)
+        last_end = min(max(missing.end, missing.start + size), total)
+        start, data, length, response = (await fetch_range(session, url, missing.start, last_end, headers))
+        if response.status != 206:
+            break
+        store_blocks(blocks, start, data, total)
+    raise ValueError('the tag parser needed too much of the file')
+
+
+
+
+# One pool of keep-alive connections for every probe, and a limit on how many probes run at once
+probe_session = None
+probe_semaphore = None
+
+
+def get_session():
+    global probe_session
+    if (probe_session is None) or probe_session.closed:
+        probe_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=BLUEZ_PROBE_CONCURRENCY * 2, keepalive_timeout=PROBE_KEEPALIVE),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=PROBE_TIMEOUT, sock_read=PROBE_TIMEOUT))
+    return probe_session
+
+
+def get_semaphore():
+    # This is made the first time a probe runs rather than when the module is imported,
+    # since on python 3.9 it would otherwise belong to whichever event loop existed then
+    global probe_semaphore
+    if probe_semaphore is None:
+        probe_semaphore = asyncio.Semaphore(BLUEZ_PROBE_CONCURRENCY)
+    return probe_semaphore
+
+
+async def probe_tags(url, headers=None):
+    # Read the tags of a remote file, fetching only the parts of it that the parser needs.
+    # Returns a TinyTag, or raises an exception if the tags can't be read.
+    async with get_semaphore():
+        session = get_session()
+        blocks = {}
+        total, response = (await fetch_ends(session, url, blocks, headers))
+        if total is None:
+            raise ValueError('the length of the file is unknown')
+        return (await read_tags(session, url, total, blocks, response.status == 206, headers))
+
+
+
+
+async def probe_direct(url):
+    # If a URL links straight to an audio file or stream, return a youtube-dl style info dict
+    # for it made from its tags, or None if it should be given to youtube-dl instead
+    if not BLUEZ_DIRECT_MEDIA:
+        return None
+    started = time.monotonic()
+    ext = url_ext(url)
+    loop = asyncio.get_event_loop()
+    if (ext not in DIRECT_MEDIA_EXTS) and (await loop.run_in_executor(None, has_extractor, url)):
+        return None
+    try:
+        async with get_semaphore():
+            info = (await asyncio.wait_for(probe_url(get_session(), url, ext), PROBE_TIMEOUT))
+    except Exception as e:
+        logging.info(f'unable to probe {url}, falling back to youtube-dl: {e!r}')
+        return None
+    if info is not None:
+        metrics.increment('direct_media')
+        metrics.sample('direct_media_probe', time.monotonic() - started)
+    return info
+
+
+async def probe_url(session, url, ext):
+    blocks = {}
+    # fetch the end of the file too if it's surely an audio file
+    total, response = (await fetch_ends(session, url, blocks, tail=(ext in DIRECT_MEDIA_EXTS)))
+    content_type = response.content_type
+    if ext not in DIRECT_MEDIA_EXTS:
+        if not content_type.startswith(DIRECT_MEDIA_TYPES):
+            return None # probably a web page
+        ext = MEDIA_TYPE_EXTS.get(content_type, ext)
+    icy_name = response.headers.get('icy-name')
+    live = (total is None) or bool(icy_name) # a stream that never ends
+    tag = None
+    if not live:
+        try:
+            tag = (await read_tags(session, url, total, blocks, response.status == 206))
+        except Exception as e:
+            logging.info(f'unable to read tags from {url}: {e!r}')
+    return direct_info(url, ext, tag, live, icy_name)
+
+
+def direct_info(url, ext, tag=None, live=False, title=None):
+    # Make a youtube-dl style info dict for a direct link
+    filename = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(url).path))
+    title = title or (tag and tag.title) or os.path.splitext(filename)[0] or url
+    if tag and tag.artist and tag.title:
+        title = f'{tag.artist} - {tag.title}'
+    return {'_type': 'video',
+            'id': hashlib.sha1(url.encode('utf-8')).hexdigest(),
+            'extractor': 'direct',
+            'extractor_key': 'Direct',
+            'title': title,
+            'duration': (tag.duration if (tag and not live) else None),
+            'artist': (tag and tag.artist),
+            'track': (tag and tag.title),
+            'asr': (tag and tag.samplerate),
+            'url': url,
+            'webpage_url': url,
+            'ext': ext or 'unknown_audio',
+            'protocol': urllib.parse.urlparse(url).scheme,
+            'is_live': live}
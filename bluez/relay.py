@@ -0,0 +1,459 @@
+# Local HTTP relay that caches the media ffmpeg fetches from upstream servers
+
+import aiohttp
+from aiohttp import web
+import asyncio
+import collections
+import hashlib
+import os
+import re
+import time
+import logging
+
+from bluez.metrics import *
+from bluez.util import *
+
+
+BLUEZ_RELAY = bool(int(os.getenv('BLUEZ_RELAY', '1')))
+BLUEZ_RELAY_CACHE_MB = int(os.getenv('BLUEZ_RELAY_CACHE_MB', '64')) # kept in memory, so keep it small on small dynos
+
+RELAY_BLOCK_SIZE = 256 * 1024 # media is cached in blocks of this many bytes
+RELAY_FETCH_BLOCKS = 32 # the maximum number of blocks to fetch from upstream in one request
+RELAY_READAHEAD_BLOCKS = 16 # start fetching the next run of blocks once a reader gets this close to it
+RELAY_TIMEOUT = 30 # seconds to wait for upstream before giving up on a request
+RELAY_DOWNLOAD_WAIT = 10 # seconds to wait for a download to reach a block before fetching it from upstream instead
+RELAY_DOWNLOAD_LOOKAHEAD = 4 * 1024 * 1024 # don't wait for a download to reach a block more than this many bytes ahead of it
+RELAY_POLL_INTERVAL = 0.1 # seconds between checks on the progress of a download
+RELAY_MAX_TRACKS = 1000 # tracks with nothing cached to keep registered before forgetting the least recently used
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+
+
+class UpstreamError(Exception):
+
+    # An error fetching media from the upstream server
+
+    def __init__(self, message, status=502):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+
+
+class CachedMedia(object):
+
+    # The bytes of one track fetched so far, stored in fixed-size blocks
+
+    def __init__(self, key, url, headers=None, download=None):
+        self.key = key
+        self.url = url
+        self.headers = dict(headers or {})
+        self.download = download # the Download of this media in progress, if any
+        self.length = None # the total size of the media, once we know it
+        self.etag = None # the ETag upstream sent for the media, if any
+        self.content_type = 'application/octet-stream'
+        self.passthrough = False # True if upstream does not support range requests
+        self.blocks = {} # block index -> bytes
+        self.pending = {} # block index -> future that is resolved when the block arrives
+        self.size = 0 # total number of bytes cached
+        self.position = 0 # the index of the block a reader asked for most recently
+        self.generation = 0 # bumped whenever the cached blocks turn out to be of a different file
+        self.unchecked = False # True if the URL has changed since the cached blocks were fetched
+
+    def num_blocks(self):
+        return (self.length + RELAY_BLOCK_SIZE - 1) // RELAY_BLOCK_SIZE
+
+    def available(self, index):
+        # return True if a block is cached or on its way
+        return (index in self.blocks) or (index in self.pending)
+
+
+
+
+class MediaRelay(object):
+
+    # An HTTP server on the loopback interface that ffmpeg reads media from instead of
+    # reading it from upstream directly. Bytes fetched from upstream are cached per track,
+    # so seeking, rewinding or changing audio effects does not download them again,
+    # and concurrent readers of the same track share the same upstream requests.
+
+    def __init__(self, host='127.0.0.1', port=0, max_cache=BLUEZ_RELAY_CACHE_MB * 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_cache = max_cache
+        self.media = collections.OrderedDict() # token -> CachedMedia, least recently used first
+        self.cache_size = 0
+        self.session = None
+        self.runner = None
+        self.base_url = None
+
+
+    async def start(self):
+        # Start listening for requests
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=RELAY_TIMEOUT,
+                                                                           sock_read=RELAY_TIMEOUT))
+        app = web.Application()
+        app.router.add_route('GET', '/{token}', self.handle)
+        app.router.add_route('HEAD', '/{token}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        self.base_url = f'http://{self.host}:{self.port}'
+
+
+    async def close(self):
+        # Stop the server and forget everything in the cache
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.media.clear()
+        self.cache_size = 0
+
+
+    def register(self, key, url, headers=None, download=None):
+        # Make the media at the given upstream URL available through the relay, and
+        # return the local URL to read it from. The key identifies the track and format, so
+        # that the cache survives the upstream URL changing (e.g. when a song is reloaded);
+        # if the new URL turns out to serve a different file, the cached blocks are dropped.
+        # If the media is being downloaded, it is read from the file as it grows,
+        # falling back to upstream for anything the download is not close to yet.
+        token = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        media = self.media.get(token)
+        if (media is None) or media.passthrough:
+            self.media[token] = CachedMedia(key, url, headers, download)
+        else:
+            if (url != media.url) and media.blocks:
+                media.unchecked = True
+            media.url = url
+            media.download = download
+            if headers:
+                media.headers = dict(headers)
+        self.media.move_to_end(token)
+        if len(self.media) > RELAY_MAX_TRACKS:
+            # forget the least recently used tracks with nothing cached, so that the relay doesn't
+            # remember every track it has ever been asked for (anything it forgets has not been read
+            # for a long time, so nothing should come asking for it again)
+            for other_token, other in tuple(self.media.items()):
+                if len(self.media) <= RELAY_MAX_TRACKS:
+                    break
+                if not (other.blocks or other.pending):
+                    del self.media[other_token]
+        return f'{self.base_url}/{token}'
+
+
+    def drop_blocks(self, media, indices=None):
+        # Forget some (by default all) of the blocks cached for a track
+        if indices is None:
+            indices = tuple(media.blocks)
+        for index in indices:
+            size = len(media.blocks.pop(index))
+            media.size -= size
+            self.cache_size -= size
+
+
+    def evict(self, keep):
+        # Evict the blocks of the least recently used tracks until the cache is back under its size limit.
+        # The tracks stay registered, since ffmpeg may still be reading them and will come back for
+        # the next range (or reconnect); the blocks are just fetched from upstream again then.
+        for media in tuple(self.media.values()):
+            if self.cache_size <= self.max_cache:
+                break
+            if (media is not keep) and not media.pending:
+                self.drop_blocks(media)
+        if self.cache_size > self.max_cache:
+            # the track being fetched (e.g. a long one being analysed) doesn't fit by itself,
+            # so forget the blocks of it that readers have already got past
+            behind = [index for index in sorted(keep.blocks) if index < keep.position]
+            while behind and (self.cache_size > self.max_cache):
+                self.drop_blocks(keep, (behind.pop(0),))
+        metrics.set('relay_cache_bytes', self.cache_size)
+
+
+
+    ##### Fetching from upstream #####
+
+
+    def fetch(self, media, index):
+        # Start fetching a run of missing blocks from upstream, beginning at the given index
+        if media.available(index) or media.passthrough:
+            return
+        end = index + 1
+        while (end < index + RELAY_FETCH_BLOCKS) and not media.available(end) and \
+              ((media.length is None) or (end < media.num_blocks())):
+            end += 1
+        loop = asyncio.get_event_loop()
+        for i in range(index, end):
+            media.pending[i] = loop.create_future()
+        asyncio.create_task(self.fetch_blocks(media, index, end))
+
+
+    async def fetch_blocks(self, media, start, end):
+        # Fetch blocks [start, end) from upstream and cache them as they arrive
+        first = start * RELAY_BLOCK_SIZE
+        last = end * RELAY_BLOCK_SIZE - 1
+        if media.length is not None:
+            last = min(last, media.length - 1)
+        headers = dict(media.headers)
+        headers['Range'] = f'bytes={first}-{last}'
+        requested_end = end
+        index = start
+        generation = media.generation
+        error = UpstreamError('fetch from upstream was interrupted')
+        metrics.increment('relay_upstream_requests')
+        try:
+            async with self.session.get(media.url, headers=headers) as response:
+                if response.status == 200:
+                    # upstream does not support range requests (e.g. a radio stream),
+                    # so readers will have to be passed straight through to it
+                    media.passthrough = True
+                    raise UpstreamError('upstream does not support range requests')
+                elif response.status != 206:
+                    raise UpstreamError(f'upstream returned {response.status} {response.reason}', response.status)
+                match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                if not match or (int(match.group(1)) != first) or (match.group(3) == '*'):
+                    media.passthrough = True
+                    raise UpstreamError('upstream returned an unexpected range')
+                length = int(match.group(3))
+                etag = response.headers.get('ETag')
+                if ((media.length is not None) and (length != media.length)) or \
+                   (etag and media.etag and (etag != media.etag)):
+                    # the upstream URL changed and now serves a different file (e.g. another format),
+                    # so whatever we cached from the old one is no use
+                    logging.info(f'relay media for {media.key} changed upstream; dropping its cached blocks')
+                    self.drop_blocks(media)
+                    media.generation += 1
+                    generation = media.generation
+                media.length = length
+                media.etag = etag or media.etag
+                media.content_type = response.headers.get('Content-Type', media.content_type)
+                end = min(end, media.num_blocks())
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(RELAY_BLOCK_SIZE):
+                    if media.generation != generation:
+                        raise UpstreamError('media changed upstream')
+                    buffer += chunk
+                    while (index < end) and ((len(buffer) >= RELAY_BLOCK_SIZE) or
+                                             (len(buffer) >= media.length - index * RELAY_BLOCK_SIZE)):
+                        size = min(RELAY_BLOCK_SIZE, media.length - index * RELAY_BLOCK_SIZE)
+                        self.store(media, index, bytes(buffer[:size]))
+                        del buffer[:size]
+                        index += 1
+                if index < end:
+                    raise UpstreamError('upstream closed the connection early')
+                # anything left over was past the end of the media
+                error = UpstreamError('requested range is past the end of the media', 416)
+        except UpstreamError as e:
+            error = e
+        except Exception as e:
+            error = UpstreamError(f'error fetching from upstream: {e}')
+        finally:
+            # fail any blocks we did not manage to get, so that readers can retry
+            for i in range(index, requested_end):
+                future = media.pending.pop(i, None)
+                if (future is not None) and not future.done():
+                    future.set_exception(error)
+                    future.exception() # mark the exception as retrieved in case nobody is waiting for it
+            self.evict(media)
+
+
+    def store(self, media, index, data):
+        # Cache a block that has arrived from upstream, and wake up anyone waiting for it
+        media.blocks[index] = data
+        media.size += len(data)
+        self.cache_size += len(data)
+        future = media.pending.pop(index, None)
+        if (future is not None) and not future.done():
+            future.set_result(data)
+
+
+    async def get_block(self, media, index):
+        # Get a block of media, from the cache if possible
+        media.position = index
+        data = media.blocks.get(index)
+        if data is not None:
+            metrics.increment('relay_cache_hits')
+        else:
+            if (media.download is not None) and not media.available(index):
+                data = (await self.read_download(media, index))
+                if data is not None:
+                    return data
+            # the block may have arrived while we were waiting for the download
+            data = media.blocks.get(index)
+        if data is None:
+            metrics.increment('relay_cache_misses')
+            self.fetch(media, index)
+            future = media.pending.get(index)
+            if future is None:
+                # fetch() didn't ask for it, e.g. because upstream turned out not to support range requests
+                raise UpstreamError('the block is not available from upstream')
+            # shield the future so that a reader going away does not cancel it for everyone else
+            data = (await asyncio.shield(future))
+        # keep the next run of blocks coming before the reader gets there
+        ahead = index + RELAY_READAHEAD_BLOCKS
+        if (media.length is not None) and (ahead < media.num_blocks()) and not media.available(ahead):
+            self.fetch(media, ahead)
+        return data
+
+
+
+    async def read_download(self, media, index):
+        # Read a block from the file the media is being downloaded to, waiting for the download
+        # to get there if it is close. Returns None if the block should come from upstream instead.
+        download = media.download
+        start = index * RELAY_BLOCK_SIZE
+        deadline = time.monotonic() + RELAY_DOWNLOAD_WAIT
+        loop = asyncio.get_event_loop()
+        while True:
+            if download.done:
+                media.length = os.path.getsize(download.path)
+            elif (media.length is None) and download.total:
+                media.length = download.total
+            if media.length is not None:
+                if start >= media.length:
+                    raise UpstreamError('requested range is past the end of the media', 416)
+                end = min(start + RELAY_BLOCK_SIZE, media.length)
+                if download.available() >= end:
+                    try:
+                        data = (await loop.run_in_executor(None, download.read, start, end - start))
+                    except OSError:
+                        break
+                    if len(data) == end - start:
+                        metrics.increment('relay_download_reads')
+                        return data
+            if (download.error is not None) or (start > download.available() + RELAY_DOWNLOAD_LOOKAHEAD) or \
+               (time.monotonic() > deadline):
+                break
+            await asyncio.sleep(RELAY_POLL_INTERVAL)
+        # e.g. somebody seeked past what has been downloaded so far
+        metrics.increment('relay_download_fallbacks')
+        return None
+
+
+
+    ##### Serving requests from ffmpeg #####
+
+
+    async def handle(self, request):
+        # Serve a (possibly ranged) request for a track
+        token = request.match_info['token']
+        media = self.media.get(token)
+        if media is None:
+            raise web.HTTPNotFound()
+        self.media.move_to_end(token)
+        match = RANGE_RE.match(request.headers.get('Range', ''))
+        start = int(match.group(1)) if (match and match.group(1)) else 0
+        checking = media.unchecked and not media.passthrough
+        if checking:
+            # the upstream URL has changed, so fetch the block this reader wants again to make sure
+            # it is still the same file (fetch_blocks() drops all the cached blocks if it isn't)
+            media.unchecked = False
+            self.drop_blocks(media, [index for index in (start // RELAY_BLOCK_SIZE,) if index in media.blocks])
+        if (media.length is None) or checking:
+            # we have to ask upstream before we know how big the media is
+            try:
+                await self.get_block(media, start // RELAY_BLOCK_SIZE)
+            except UpstreamError as e:
+                if not media.passthrough:
+                    return web.Response(status=e.status, text=str(e))
+        if media.passthrough:
+            return (await self.passthrough(request, media))
+        if match and not match.group(1):
+            # suffix range: the last N bytes
+            start = max(media.length - int(match.group(2) or 0), 0)
+            stop = media.length - 1
+        elif match and match.group(2):
+            stop = min(int(match.group(2)), media.length - 1)
+        else:
+            stop = media.length - 1
+        if start >= media.length:
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{media.length}'})
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': media.content_type,
+                   'Content-Length': str(stop - start + 1)}
+        if match:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop}/{media.length}'
+        else:
+            status = 200
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+        position = start
+        try:
+            while position <= stop:
+                index = position // RELAY_BLOCK_SIZE
+                data = (await self.get_block(media, index))
+                if token in self.media:
+                    self.media.move_to_end(token) # still being read, so evict other tracks first
+                offset = position - index * RELAY_BLOCK_SIZE
+                data = data[offset : offset + stop - position + 1]
+                await response.write(data)
+                position += len(data)
+        except UpstreamError as e:
+            # it's too late to send an error status, so just cut the connection;
+            # ffmpeg will reconnect and ask for the rest
+            logging.warning(f'relay error for {media.key}: {e}')
+            request.transport.close()
+        except ConnectionResetError:
+            pass # ffmpeg went away (e.g. the song was skipped or seeked)
+        return response
+
+
+    async def passthrough(self, request, media):
+        # Relay a request straight to upstream without caching anything
+        headers = dict(media.headers)
+        if 'Range' in request.headers:
+            headers['Range'] = request.headers['Range']
+        metrics.increment('relay_upstream_requests')
+        async with self.session.request(request.method, media.url, headers=headers) as upstream:
+            response = web.StreamResponse(status=upstream.status)
+            for name in ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges'):
+                if name in upstream.headers:
+                    response.headers[name] = upstream.headers[name]
+            await response.prepare(request)
+            if request.method != 'HEAD':
+                try:
+                    async for chunk in upstream.content.iter_chunked(RELAY_BLOCK_SIZE):
+                        await response.write(chunk)
+                except ConnectionResetError:
+                    pass # ffmpeg went away
+        return response
+
+
+
+
+relay = None
+relay_starting = None # the task starting the relay, while it is starting
+
+async def start_relay():
+    new_relay = MediaRelay()
+    await new_relay.start()
+    return new_relay
+
+async def get_relay():
+    # Get the relay, starting it if it is not running yet. Callers that arrive while it is
+    # starting wait for the same start, so nobody gets a relay that isn't listening yet.
+    global relay, relay_starting
+    if relay is None:
+        if relay_starting is None:
+            relay_starting = asyncio.ensure_future(start_relay())
+        starting = relay_starting
+        try:
+            # shield the start so that a caller going away does not cancel it for everyone else
+            started = (await asyncio.shield(starting))
+        except Exception:
+            if relay_starting is starting:
+                relay_starting = None # let the next caller try again
+            raise
+        if relay is None:
+            relay = started
+            relay_starting = None
+    return relay
@@ -1,15 +1,23 @@
 # Individual song class
 
-import discord
 import yt_dlp
 import tinytag
-import httpio
 import asyncio
 import re
 import os
+import math
 import logging
 import urllib.parse
 
+from bluez.analysis import *
+from bluez.audio import *
+from bluez.broadcast import *
+from bluez.download import *
+from bluez.library import *
+from bluez.probe import *
+from bluez.relay import *
+from bluez.storage import *
+from bluez.transcode import *
 from bluez.util import *
 
 
@@ -20,6 +28,7 @@ BASS_BOOST_DB = 5
 TREBLE_ATTENUATE_DB = 2
 METADATA_TIMEOUT = 30
 
+PROBE_SIZE = 32768 # how many bytes ffmpeg may read to find the stream parameters when we give it input hints
 MAX_TIME_VALUE = 36000000 # ffmpeg does not allow timestamps of 10000 hours or more
 MAX_INPUT_LENGTH = 30
 
@@ -40,6 +49,24 @@ SEARCH_INFO = {
 
 
 
+# ffmpeg demuxers for the file extensions youtube-dl reports, so that ffmpeg
+# does not have to probe the input to figure out what format it is in
+INPUT_FORMATS = {
+    'm4a'  : 'mov',
+    'mp4'  : 'mov',
+    'webm' : 'matroska',
+    'mka'  : 'matroska',
+    'mp3'  : 'mp3',
+    'ogg'  : 'ogg',
+    'oga'  : 'ogg',
+    'opus' : 'ogg',
+    'flac' : 'flac',
+    'wav'  : 'wav',
+    'aac'  : 'aac',
+    }
+
+
+
 # Youtube-DL options
 YTDL_OPTIONS = {
     'format': 'bestaudio/best',
@@ -64,8 +91,71 @@ YTDL_OPTIONS = {
 
 
 
+class MetadataTasks(object):
+
+    # Looks up the metadata of each track only once however many songs are waiting for it
+    # (e.g. when the same track is queued in several guilds), and gives the result to all
+    # of them. Once none of those songs are on a queue any more, the lookup is cancelled.
+
+    def __init__(self):
+        self.tasks = {} # key -> task looking up the metadata
+        self.waiting = {} # key -> list of songs waiting for it
+
+
+    def join(self, song):
+        # Start looking up the metadata for a song, or wait for the lookup already under way.
+        # Returns the task.
+        key = song.metadata_key = song.get_key()
+        self.waiting.setdefault(key, []).append(song)
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.create_task(self.fetch(key, song))
+        else:
+            metrics.increment('metadata_shared')
+        return task
+
+
+    def leave(self, song):
+        # Stop waiting on behalf of a song, and cancel the lookup if nobody else is waiting
+        key = getattr(song, 'metadata_key', None)
+        waiting = self.waiting.get(key)
+        if waiting is None:
+            return
+        waiting[:] = [other for other in waiting if other is not song]
+        if not waiting:
+            # forget the lookup straight away, so that a song joining before the task
+            # has finished cancelling starts a new one rather than waiting for this one
+            del self.waiting[key]
+            self.tasks.pop(key).cancel()
+            metrics.increment('metadata_cancelled')
+
+
+    async def fetch(self, key, song):
+        try:
+            tag = (await asyncio.wait_for(song.get_tags(), METADATA_TIMEOUT))
+            if tag is not None:
+                for other in self.waiting.get(key, ()):
+                    other.apply_tags(tag)
+        except asyncio.TimeoutError:
+            logging.warning(f'timed out while getting metadata for "{song.name}"')
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
+                del self.waiting[key]
+
+
+
+
+metadata_tasks = MetadataTasks()
+
+
+
+
+
 class Song(object):
 
+    renames = 0 # bumped whenever any song's name or link changes, so indexes of songs by identity know to refresh
+
     def __init__(self, ydl, data, user):
         self.ydl = ydl
         self.data = data
@@ -73,16 +163,40 @@ class Song(object):
         self.tempo = 1.0
         self.adjusted_length = 0
         self.error = None
+        self.probe_hints = True # set to False if ffmpeg can't cope with the input hints for this song
+        self.hinted = False
+        self.played = False # set once audio has been requested for this song
+        self.dropped = False # set once this song has been taken off the queue without being played
+        self.queue = None # the SongQueue this song is on, if any
+        self.queue_block = None # the block of that queue the song is in
         self.init()
 
     def __eq__(self, other):
         return isinstance(other, Song) and (self.name == other.name) and (self.link == other.link)
 
+    def identity(self):
+        # The part of a song that equality looks at, for hashing songs into indexes
+        return (self.name, self.link)
+
+    @property
+    def length(self):
+        return self._length
+
+    @length.setter
+    def length(self, length):
+        # let the queue this song is on know, so that it can keep its running totals right
+        # (which are in whole milliseconds, so that they don't drift)
+        old = getattr(self, 'length_ms', 0)
+        self._length = length
+        self.length_ms = round((length or 0) * 1000)
+        if getattr(self, 'queue', None) is not None:
+            self.queue.length_changed(self, old)
+
 
     def init(self):
         # initialize the data for a Song object
         self.name = self.data.get('title', '[no title]')
-        self.length = self.adjusted_length = self.data.get('duration') or 0
+        self.duration = self.length = self.adjusted_length = self.data.get('duration') or 0
         self.thumbnail = self.data.get('thumbnail')
         self.channel = self.data.get('channel', 'None')
         self.channel_url = self.data.get('channel_url')
@@ -115,9 +229,15 @@ class Song(object):
             # this song has a URL loaded and ready to go
             self.link = self.data.get('webpage_url', getattr(self, 'link', None))
             if BLUEZ_DOWNLOAD:
-                self.url = self.data['requested_downloads'][0]['filepath']
+                if 'requested_downloads' in self.data:
+                    self.url = self.data['requested_downloads'][0]['filepath']
+                else:
+                    # where the file will be once it has been downloaded (see fetch_download())
+                    self.url = self.ydl.prepare_filename(self.data)
             else:
                 self.url = self.data['url']
+        # skip silence at the start and end if we already know where it is
+        self.trim_silence()
 
 
 
@@ -125,47 +245,105 @@ class Song(object):
         # trim a song's length if its start and end are specified
         if self.length and ((self.start is not None) or (self.end is not None)):
             if self.end is not None:
-                self.length = min(self.end, self.length) - (self.start or 0)
+                self.length = min(self.end, self.duration) - (self.start or 0)
             else:
-                self.length -= self.start
+                self.length = self.duration - self.start
             if self.length <= 0:
                 self.length = 0
                 if self.error is None:
                     self.error = Exception('start time later than end of song, no audio data')
             self.adjusted_length = self.length / self.tempo
+
+
+    def trim_silence(self):
+        # skip the silence at the start and end of a song, if the analysis has found any.
+        # start and end times given in the song's URL take precedence.
+        key = self.get_key()
+        if not (BLUEZ_ANALYSIS and BLUEZ_TRIM_SILENCE and key and trackdb.has(key, 'audio_start')) or self.error:
+            return
+        # ffmpeg is given whole seconds, so round outward rather than cutting off any audio
+        audio_start = math.floor(trackdb.get(key, 'audio_start'))
+        audio_end = trackdb.get(key, 'audio_end')
+        if (self.start is None) and (audio_start > 0) and ((self.end is None) or (audio_start < self.end)):
+            self.start = audio_start
+        if (self.end is None) and (audio_end is not None) and (math.ceil(audio_end) > (self.start or 0)):
+            self.end = math.ceil(audio_end)
+        self.trim()
             
         
         
-    async def process(self):
-        # process a Song (i.e. actually ask youtube-dl to find the URL
-        # for it rather than delaying it till later).
+    async def resolve(self):
+        # ask youtube-dl to find the URL for this song, if it hasn't yet
         if self.url is None:
             loop = asyncio.get_event_loop()
+            identity = self.identity()
             try:
-                self.data = (await loop.run_in_executor(None, lambda: self.ydl.process_ie_result(self.data, download=BLUEZ_DOWNLOAD)))
+                self.data = (await loop.run_in_executor(None, lambda: self.ydl.process_ie_result(self.data, download=False)))
             except Exception as e:
                 self.error = e
             self.init()
-        # Get metadata if we need to
+            if self.identity() != identity:
+                Song.renames += 1
+        
+        
+    async def process(self):
+        # process a Song (i.e. actually ask youtube-dl to find the URL
+        # for it rather than delaying it till later).
+        await self.resolve()
+        # Start downloading and get metadata if we need to
+        self.fetch_download()
         self.fetch_metadata()
+        self.fetch_analysis()
 
 
+    async def fetch_length(self):
+        # Find out the length of this song if we don't know it yet, without
+        # downloading or analyzing it (which can wait until it is played)
+        if self.url is not None:
+            self.fetch_metadata()
+            if hasattr(self, 'metadata_task'):
+                await asyncio.wait([self.metadata_task]) # (which may be cancelled if we are dropped)
+            return
+        # Ask youtube-dl about a copy of the data, and keep only the length. The stream URL it finds
+        # is signed and expires after a few hours, which a song far down the queue may well outlast,
+        # so resolve() finds a fresh one when the song is about to be played instead.
+        loop = asyncio.get_event_loop()
+        data = dict(self.data)
+        info = (await loop.run_in_executor(None, lambda: self.ydl.process_ie_result(data, download=False)))
+        duration = info.get('duration')
+        if (not duration) and info.get('url') and is_url(info['url']) and not info.get('is_live'):
+            # a direct link to a file, so read the length from its tags
+            duration = (await probe_tags(info['url'], info.get('http_headers'))).duration
+        if duration and not (self.url or self.length):
+            self.data['duration'] = duration
+            self.duration = self.length = float(duration)
+            self.trim()
+            self.adjusted_length = self.length / self.tempo
+
 
 
-    async def get_metadata(self):
-        # try to get information from the metadata of a song
+
+    async def get_tags(self):
+        # try to read the metadata of a song, and return the tag object or None
+        url = self.url
+        if BLUEZ_DOWNLOAD and not self.is_downloaded():
+            url = self.data.get('url') or url # it hasn't been downloaded yet, so look at the original
         try:
-            with httpio.open(self.url) as fp:
-                parser_class = tinytag.TinyTag.get_parser_class(fp.url, fp)
-                tag = parser_class(fp, fp.length)
+            if is_url(url):
+                # only the parts of the file that the tag parser needs are fetched
+                return (await probe_tags(url, self.data.get('http_headers')))
+            else:
                 loop = asyncio.get_event_loop()
-                await loop.run_in_executor(None, lambda: tag.load(tags=True, duration=True))
+                return (await loop.run_in_executor(None, lambda: tinytag.TinyTag.get(url, tags=True, duration=True)))
         except Exception as error:
             logging.warning(f'unable to get metadata for "{self.name}": {error}')
-            return
-        # If successful, set information from this tag object
-        if not self.length:
-            self.length = float(tag.duration)
+            return None
+
+
+    def apply_tags(self, tag):
+        # set information from a tag object
+        if (not self.length) and tag.duration:
+            self.duration = self.length = float(tag.duration)
             self.trim()
             self.adjusted_length = self.length / self.tempo
         if self.artist is None:
@@ -177,20 +355,20 @@ class Song(object):
                 self.name = f'{self.artist} - {self.track}'
             else:
                 self.name = self.track
+            Song.renames += 1
 
 
-    async def get_metadata_with_timeout(self, timeout):
-        # try to get the metadata, but don't wait forever
-        try:
-            await asyncio.wait_for(self.get_metadata(), timeout)
-        except asyncio.TimeoutError:
-            logging.warning(f'timed out while getting metadata for "{self.name}"')
+    def fetch_metadata(self):
+        # Begin loading the metadata asynchronously (along with any other songs of the same track)
+        if not (self.length or self.error or self.dropped or hasattr(self, 'metadata_task')):
+            self.metadata_task = metadata_tasks.join(self)
 
 
-    def fetch_metadata(self):
-        # Begin loading the metadata asynchronously
-        if not (self.length or self.error or hasattr(self, 'metadata_task')):
-            self.metadata_task = asyncio.create_task(self.get_metadata_with_timeout(METADATA_TIMEOUT))
+    def drop(self):
+        # Called when this song has been taken off the queue without being played,
+        # so that we stop finding things out about it unless another song needs them
+        self.dropped = True
+        metadata_tasks.leave(self)
         
         
         
@@ -201,30 +379,191 @@ class Song(object):
         logging.warning(f'Attempting to reload "{self.name}"')
         songs = (await songs_from_url(self.link, self.user))
         if songs:
-            self.__dict__.update(songs[0].__dict__)
+            identity = self.identity()
+            state = dict(songs[0].__dict__)
+            length = state.pop('_length')
+            del state['length_ms']
+            del state['queue'], state['queue_block'] # this song is still wherever it was
+            self.__dict__.update(state)
+            self.length = length
+            if self.identity() != identity:
+                Song.renames += 1
+
+
+
+    async def get_input_url(self):
+        # Get the URL ffmpeg should read this song from. Streams are read through the
+        # local relay where possible, so that bytes we already have are not fetched again.
+        url = self.url
+        download = None
+        if BLUEZ_DOWNLOAD:
+            if self.is_downloaded():
+                storage.touch(self.url)
+                return self.url
+            # play what has been downloaded so far, and stream anything it hasn't reached yet
+            # (downloading it again if it was evicted from the cache)
+            self.fetch_download()
+            url = self.data.get('url')
+            download = downloader.get(self.url)
+            if (download is not None) and (download.error is not None):
+                download = None
+        if not BLUEZ_RELAY:
+            return url
+        if self.data.get('is_live') or (self.data.get('protocol', 'https') not in ('http', 'https')):
+            return url # e.g. HLS playlists, which refer to other URLs relative to themselves
+        relay = (await get_relay())
+        # the same track may come in several formats, which are different files
+        key = f'{self.get_key()}#{self.data.get("format_id") or self.data.get("ext")}'
+        return relay.register(key, url, self.data.get('http_headers'), download)
+
+
+
+    def fetch_download(self):
+        # Begin downloading the file for this song in the background, if we need to
+        if BLUEZ_DOWNLOAD and self.url and not (self.error or self.data.get('is_live')) and \
+           ('requested_downloads' not in self.data):
+            downloader.start(self.ydl, self.data)
+
+
+
+    def is_downloaded(self):
+        # Return True if the whole file for this song is on disk
+        download = downloader.get(self.url)
+        if (download is not None) and download.done:
+            self.url = download.path
+        return os.path.exists(self.url)
+
+
+
+    def is_local(self):
+        # Return True if this song is a file in the local library
+        return self.data.get('protocol') == 'file'
+
+
+
+    def get_key(self):
+        # Get the key that identifies this track in caches, regardless of which guild is playing it
+        return self.link or self.url
+
+
+
+    def fetch_analysis(self):
+        # Begin measuring the loudness of this song in the background, unless it has been already
+        if not (BLUEZ_ANALYSIS and self.url) or self.error or self.data.get('is_live'):
+            return
+        if not (0 < self.length <= MAX_ANALYSIS_LENGTH):
+            return # could be a radio stream, which would never finish
+        if BLUEZ_DOWNLOAD or self.is_local():
+            before_options = ''
+        else:
+            before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+        analyzer.submit(self.get_key(), self.get_input_url, before_options)
+        if not hasattr(self, 'analysis_task'):
+            self.analysis_task = asyncio.create_task(self.wait_for_analysis())
+
+
+    async def wait_for_analysis(self):
+        # Skip silence as soon as the analysis is done, unless the song has started playing already
+        await analyzer.wait(self.get_key())
+        if not self.played:
+            self.trim_silence()
+
 
 
+    def get_normalization(self):
+        # Get the gain that brings this song to the target loudness, if it has been measured
+        key = self.get_key()
+        if not (BLUEZ_ANALYSIS and trackdb.has(key, 'loudness')):
+            return 1.0
+        return loudness_gain(trackdb.get(key, 'loudness'), trackdb.get(key, 'peak'))
 
-    def get_source(self, before_options='', options='', stderr=None, volume=1.0):
+
+
+    def get_transcoded(self, bitrate=None):
+        # Get a tuple (path, gain) for the Ogg/Opus version of this song if it has been downloaded
+        # and transcoded, or None if it hasn't; in that case queue it to be transcoded in the background
+        if not (BLUEZ_DOWNLOAD and BLUEZ_TRANSCODE) or self.is_local():
+            return None # (library files are left alone)
+        if not (self.is_downloaded() and bitrate):
+            return None # (the file is only any use at the bitrate of the channel)
+        transcoded = transcoder.lookup(self.url, bitrate)
+        if transcoded is None:
+            asyncio.create_task(self.transcode(bitrate))
+        return transcoded
+
+
+    async def transcode(self, bitrate):
+        # Queue this song to be transcoded once its loudness has been measured,
+        # so that the loudness normalization can be baked in too
+        await analyzer.wait(self.get_key())
+        transcoder.submit(self.url, bitrate, TRANSCODE_GAIN * self.get_normalization())
+
+
+
+    def get_input_hints(self, url):
+        # Get ffmpeg input options that tell it the format of this song, so that it can
+        # start decoding without probing the input first. Returns '' if we don't know the format.
+        if not self.probe_hints:
+            return ''
+        if not is_url(url):
+            ext = os.path.splitext(url)[1].lstrip('.')
+        elif self.data.get('protocol', 'https') in ('http', 'https'):
+            ext = self.data.get('ext')
+        else:
+            return ''
+        input_format = INPUT_FORMATS.get(ext)
+        if input_format is None:
+            return ''
+        return f'-f {input_format} -probesize {PROBE_SIZE} -analyzeduration 0'
+
+
+
+    def get_source(self, url, before_options='', options='', volume=1.0, passthrough=False, ticket=None, broadcast=None):
+        # start ffmpeg and wrap it in an audio source. if broadcast is a tuple (key, position),
+        # the audio is shared with any other guild that wants the same thing at a compatible position.
         try:
-            source = discord.FFmpegPCMAudio(self.url, before_options=before_options, options=options, stderr=stderr)
-            # Adjust the volume if possible
-            if volume != 1.0:
-                source = discord.PCMVolumeTransformer(source, volume)
-            return source
+            if passthrough:
+                # the file is already Opus at the right gain, so it can be sent to discord as it is
+                audio = FFmpegOpusAudio(url, codec='copy', before_options=before_options, options=options)
+                metric = 'startup_passthrough'
+            else:
+                audio = FFmpegPCMAudio(url, before_options=before_options, options=options)
+                metric = ('startup_hinted' if self.hinted else 'startup_probed')
+            audio.ticket = ticket
+            if broadcast is not None:
+                key, position = broadcast
+                return start_broadcast(key, audio, position, bool(self.data.get('is_live')), startup_metric=metric)
+            source = BufferedSource(audio, startup_metric=metric)
+            if passthrough:
+                return source
+            # ffmpeg applies the volume, but wrap the source so it can be changed while playing
+            return VolumeTransformer(source, volume)
         except Exception as e:
             return e
     
 
 
-    async def get_audio(self, seek_pos=0, tempo=1.0, pitch=1.0, bass=1, nightcore=False, slowed=False, volume=1.0, stderr=None):
+    async def get_audio(self, seek_pos=0, tempo=1.0, pitch=1.0, bass=1, nightcore=False, slowed=False, volume=1.0,
+                        bitrate=None, ticket=None):
         # given start position and audio effect parameters, returns
-        # an audio source object that can be played using a voice client
+        # an audio source object that can be played using a voice client.
+        # the admission ticket, if any, is released when the source is cleaned up
         await self.process()
         if self.error:
             return self.error
-        if BLUEZ_DOWNLOAD:
-            before_options = ''
+        if seek_pos == 0:
+            self.trim_silence()
+        self.played = True
+        transcoded = self.get_transcoded(bitrate)
+        if transcoded:
+            url, gain = transcoded
+            asr = 48000
+        else:
+            url = (await self.get_input_url())
+            gain = 1.0
+            asr = self.asr
+        if not is_url(url):
+            before_options = '' # a file on disk
         else:
             before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
         self.tempo = get_adjusted_tempo(tempo, nightcore, slowed)
@@ -239,7 +578,16 @@ class Song(object):
             before_options += f' -ss {format_time(seek_pos * self.tempo)}'
         if self.end is not None:
             before_options += f' -to {format_time(self.end * self.tempo)}'
+        hints = self.get_input_hints(url)
+        self.hinted = bool(hints)
+        if hints:
+            before_options += ' ' + hints
         af = []
+        # change the volume and normalize the loudness
+        # (transcoded files already have some gain applied)
+        level = volume * self.get_normalization() / gain
+        if abs(level - 1.0) > 1e-6:
+            af.append(f'volume={level:.6g}')
         # change the bass and treble gains if bass-boosting is turned on
         if bass != 1:
             bass_gain = BASS_BOOST_DB * (bass-1)
@@ -250,7 +598,6 @@ class Song(object):
         # tempo/pitch is first adjusted by varying the sampling rate,
         # then tempo can be additionally altered by using the atempo filter
         if (self.tempo != 1.0) or (pitch != 1.0):
-            asr = self.asr
             if pitch != 1.0:
                 if asr is None:
                     asr = 44100
@@ -272,14 +619,21 @@ class Song(object):
         if af:
             af = ','.join(af)
             options += f' -af "{af}"'
+        # with no filters to apply, a transcoded file does not need to be decoded at all
+        passthrough = bool(transcoded) and not af
+        broadcast = None
+        if BLUEZ_BROADCAST:
+            # if another guild is already playing this with the same effects and end time, listen in on it
+            # (the start time is covered by the position; the -to in before_options is not)
+            broadcast = ((self.get_key(), self.end, options, passthrough), seek_pos)
+            reader = join_broadcast(*broadcast)
+            if reader is not None:
+                if ticket is not None:
+                    ticket.release() # we don't need to start ffmpeg after all
+                return reader
         loop = asyncio.get_event_loop()
-        source = (await loop.run_in_executor(None, lambda: self.get_source(before_options, options, stderr, volume)))
-        # Check for an error written to the stream
-        error = get_error(stderr)
-        if error:
-            return Exception(error)
-        # Otherwise return the source
-        return source
+        return (await loop.run_in_executor(None, lambda: self.get_source(url, before_options, options, volume, passthrough,
+                                                                         ticket, broadcast)))
         
 
 
@@ -343,33 +697,23 @@ def get_adjusted_tempo(tempo=1.0, nightcore=False, slowed=False):
 
 
 
-def get_error(stderr):
-    # check if an error message has been written to the stream
-    if stderr is not None:
-        stderr.flush()
-        if stderr.tell() != 0:
-            stderr.seek(0)
-        error = stderr.read()
-        if error:
-            stderr.seek(0)
-            stderr.truncate()
-            return error.decode('latin-1')
-        
-
-
-
 async def extract_info(ydl, url):
     # ask youtube-dl to get the info for a given URL or search query, running
     # the command in the asyncio event loop to avoid blocking.
     loop = asyncio.get_event_loop()
-    return (await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=BLUEZ_DOWNLOAD)))
+    # (songs are downloaded in the background later on, if they need to be)
+    return (await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False)))
 
 
 
 async def songs_from_url(url, user):
     # find and return songs from the given URL
-    ydl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
-    data = (await extract_info(ydl, url))
+    # links straight to audio files don't need youtube-dl to find them (or even
+    # a YoutubeDL object, which is slow to create, unless it is going to download them)
+    data = (await probe_direct(url))
+    ydl = (yt_dlp.YoutubeDL(YTDL_OPTIONS) if ((data is None) or BLUEZ_DOWNLOAD) else None)
+    if data is None:
+        data = (await extract_info(ydl, url))
     if data.get('_type') == 'playlist':
         return Playlist(ydl, data, user)
     else:
@@ -377,6 +721,14 @@ async def songs_from_url(url, user):
 
 
 
+def songs_from_library(query, user):
+    # find and return the song in the local library that the given search query names, if any,
+    # which needs neither youtube-dl nor the network
+    path = library.best_match(query)
+    return ([] if path is None else [Song(None, library.info(path), user)])
+
+
+
 async def songs_from_search(query, user, start, maxn, search_key):
     # find and return songs matching the given search query
     ydl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
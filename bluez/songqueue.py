@@ -0,0 +1,510 @@
+# The song queue, as a sequence with fast access to any position
+
+import bisect
+import collections
+import itertools
+import random
+
+from bluez.song import *
+
+
+QUEUE_BLOCK_SIZE = 128 # songs per block; blocks are split once they get twice this big
+QUEUE_MIN_BLOCK_SIZE = QUEUE_BLOCK_SIZE // 2 # blocks smaller than this are merged with the next one
+
+
+
+
+def requester(song):
+    # The id of the user who queued a song, for counting songs per user
+    return getattr(song.user, 'id', None)
+
+
+def fenwick(values):
+    # Build a Fenwick tree (with an unused 0th entry) over a list of numbers
+    tree = [0] + list(values)
+    for i in range(1, len(tree)):
+        j = i + (i & -i)
+        if j < len(tree):
+            tree[j] += tree[i]
+    return tree
+
+
+def fenwick_add(tree, b, delta):
+    # Add delta to the bth number in a Fenwick tree
+    i = b + 1
+    while i < len(tree):
+        tree[i] += delta
+        i += i & -i
+
+
+def fenwick_sum(tree, b):
+    # Get the sum of the first b numbers in a Fenwick tree
+    total = 0
+    while b > 0:
+        total += tree[b]
+        b -= b & -b
+    return total
+
+
+
+
+class SongQueue(object):
+
+    # A list of songs stored in blocks of a bounded size, with a Fenwick tree over the sizes
+    # of the blocks. Finding, inserting or deleting the song at any position takes O(log n)
+    # time (plus shifting at most 2 * QUEUE_BLOCK_SIZE songs around within a block), where
+    # a deque takes O(n) for anything away from its ends. Inserting or deleting a run of k
+    # songs at once takes O(k + n / QUEUE_BLOCK_SIZE). It supports the parts of the deque
+    # interface the player uses, so it can be used in the same way.
+    # It also counts the songs by identity, so that checking whether an equal song is
+    # queued (e.g. for preventing duplicates) takes O(1) time rather than O(n), and
+    # by the user who queued them, for the limit on songs per user.
+    # The total length of the songs in each block is kept in another Fenwick tree, so the
+    # total length of the queue, and the time until the song at some position plays, take
+    # O(log n) time. Songs tell the queue they are on when their length changes (see
+    # Song.length), and know which block they are in so that only that block is updated.
+    # A snapshot of the queue (e.g. for showing it a page at a time) just keeps the blocks
+    # as they are; blocks that a snapshot has are copied before they are next changed.
+
+    def __init__(self, songs=()):
+        self.blocks = []
+        self.sums = [] # total length of each block, in milliseconds
+        self.tree = fenwick([]) # Fenwick tree over len(block) for each block
+        self.times = fenwick([]) # Fenwick tree over self.sums
+        self.index_of = {} # id(block) -> position of the block in self.blocks
+        self.frozen = set() # ids of blocks that a snapshot has, which must not be changed in place
+        self.length = 0
+        self.counts = collections.Counter() # song identity -> number of queued songs with it
+        self.renames = Song.renames # the value of Song.renames when self.counts was last right
+        self.users = collections.Counter() # user id -> number of songs they have queued
+        self.members = collections.Counter() # id(song) -> number of times that song is queued
+        self.extend(songs)
+
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def __reversed__(self):
+        for block in reversed(self.blocks):
+            yield from reversed(block)
+
+    def __contains__(self, song):
+        return self.count(song) > 0
+
+    def __repr__(self):
+        return f'SongQueue({list(self)!r})'
+
+
+
+    # The blocks
+
+    def _rebuild(self):
+        # Split blocks that are too big, merge blocks that are too small into their neighbours,
+        # drop empty ones, add up any blocks whose total length is not known (new ones are added
+        # with a total of None), and rebuild the Fenwick trees (O(number of blocks), plus the
+        # size of the new blocks). Every block but the last ends up with at least
+        # QUEUE_MIN_BLOCK_SIZE songs, so there are at most n / QUEUE_MIN_BLOCK_SIZE + 1 blocks.
+        blocks = []
+        sums = []
+        for block, total in zip(self.blocks, self.sums):
+            if not block:
+                continue
+            if blocks and ((len(blocks[-1]) < QUEUE_MIN_BLOCK_SIZE) or (len(block) < QUEUE_MIN_BLOCK_SIZE)):
+                # merge this block into the one before it (in a new list, since a snapshot may have either)
+                block = blocks.pop() + block
+                sums.pop()
+                total = None
+                if len(block) > 2 * QUEUE_BLOCK_SIZE:
+                    half = len(block) // 2
+                    blocks.append(block[:half])
+                    sums.append(None)
+                    block = block[half:]
+            if len(block) > 2 * QUEUE_BLOCK_SIZE:
+                for i in range(0, len(block), QUEUE_BLOCK_SIZE):
+                    blocks.append(block[i:i+QUEUE_BLOCK_SIZE])
+                    sums.append(None)
+                if len(blocks[-1]) < QUEUE_MIN_BLOCK_SIZE:
+                    # don't leave a small piece at the end
+                    blocks[-2:] = [blocks[-2] + blocks[-1]]
+                    sums.pop()
+            else:
+                blocks.append(block)
+                sums.append(total)
+        for b, block in enumerate(blocks):
+            if sums[b] is None:
+                total = 0
+                for song in block:
+                    total += song.length_ms
+                    song.queue_block = block
+                sums[b] = total
+        self.blocks = blocks
+        self.sums = sums
+        self.tree = fenwick(len(block) for block in blocks)
+        self.times = fenwick(sums)
+        self.index_of = {id(block): b for b, block in enumerate(blocks)}
+        self.frozen.intersection_update(self.index_of)
+
+    def _writable(self, b):
+        # Get block b to change in place, copying it first if a snapshot has it
+        block = self.blocks[b]
+        if id(block) in self.frozen:
+            self.frozen.discard(id(block))
+            del self.index_of[id(block)]
+            block = self.blocks[b] = list(block)
+            self.index_of[id(block)] = b
+            for song in block:
+                song.queue_block = block
+        return block
+
+    def _add(self, b, size, time):
+        # Change the recorded size and total length of block b
+        self.sums[b] += time
+        fenwick_add(self.tree, b, size)
+        fenwick_add(self.times, b, time)
+
+    def _locate(self, index):
+        # Find the block containing the song at a position (0 <= index < len(self)).
+        # Returns a tuple (block number, position within the block).
+        b = 0
+        step = 1 << (len(self.tree).bit_length() - 1)
+        while step:
+            if (b + step < len(self.tree)) and (self.tree[b + step] <= index):
+                b += step
+                index -= self.tree[b]
+            step >>= 1
+        return (b, index)
+
+    def _index(self, index, insert=False):
+        # Normalize a position the way lists do
+        if index < 0:
+            index += self.length
+        if insert:
+            return min(max(index, 0), self.length)
+        if not (0 <= index < self.length):
+            raise IndexError('queue index out of range')
+        return index
+
+    def _slice(self, key):
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError('queue slices must be contiguous')
+        return (start, max(start, stop))
+
+
+
+    # Indexes, which are updated whenever songs are put on or taken off the queue
+
+    def _added(self, songs):
+        for song in songs:
+            self.members[id(song)] += 1
+            song.queue = self
+        self.users.update(requester(song) for song in songs)
+        if self.renames == Song.renames:
+            self.counts.update(song.identity() for song in songs)
+
+    def _removed(self, songs):
+        for song in songs:
+            self.members[id(song)] -= 1
+            if not self.members[id(song)]:
+                del self.members[id(song)]
+                song.queue = song.queue_block = None
+        self.users.subtract(requester(song) for song in songs)
+        for song in songs:
+            if self.users.get(requester(song)) == 0:
+                del self.users[requester(song)]
+        if self.renames == Song.renames:
+            self.counts.subtract(song.identity() for song in songs)
+            for song in songs:
+                if self.counts.get(song.identity()) == 0:
+                    del self.counts[song.identity()]
+
+    def _refresh(self):
+        # If any song has been renamed since the counts were right (e.g. a song from a playlist
+        # that has been looked up), they might not be any more, so count the songs again
+        if self.renames != Song.renames:
+            self.counts = collections.Counter(song.identity() for song in self)
+            self.renames = Song.renames
+
+
+    def length_changed(self, song, old):
+        # Called by a song on this queue when its length changes (old is its old length_ms)
+        delta = song.length_ms - old
+        if not delta:
+            return
+        b = self.index_of.get(id(song.queue_block))
+        if (self.members.get(id(song)) == 1) and (b is not None) and any(other is song for other in self.blocks[b]):
+            self._add(b, 0, delta)
+        else:
+            # the song is queued more than once, so we don't know which blocks it is in; add them all up again
+            self.sums = [None] * len(self.blocks)
+            self._rebuild()
+
+
+
+    # Access
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = self._slice(key)
+            return self.range(start, stop)
+        b, i = self._locate(self._index(key))
+        return self.blocks[b][i]
+
+    def __setitem__(self, key, song):
+        b, i = self._locate(self._index(key))
+        old = self.blocks[b][i]
+        self._removed([old])
+        block = self._writable(b)
+        block[i] = song
+        song.queue_block = block
+        self._add(b, 0, song.length_ms - old.length_ms)
+        self._added([song])
+
+    def range(self, start, stop):
+        # Get a list of the songs from position start up to (not including) stop
+        songs = []
+        if start >= stop:
+            return songs
+        b, i = self._locate(start)
+        while (len(songs) < stop - start) and (b < len(self.blocks)):
+            songs.extend(self.blocks[b][i:i + stop - start - len(songs)])
+            b += 1
+            i = 0
+        return songs
+
+    def snapshot(self):
+        # Get the songs on the queue as they are now, without copying them (O(n / QUEUE_BLOCK_SIZE))
+        self.frozen.update(self.index_of)
+        return QueueSnapshot(list(self.blocks))
+
+    def index(self, song, start=0):
+        # Find the position of the first song equal to the given one (O(n))
+        for i, other in enumerate(self):
+            if (i >= start) and (other == song):
+                return i
+        raise ValueError('song is not in queue')
+
+    def count_user(self, user):
+        # Count the songs queued by a user (O(1))
+        return self.users.get(getattr(user, 'id', None), 0)
+
+    def count(self, song):
+        # Count the songs equal to the given one (O(1))
+        if not isinstance(song, Song):
+            return 0
+        self._refresh()
+        return self.counts.get(song.identity(), 0)
+
+
+    def total_length(self):
+        # The total length of the songs in the queue, in seconds
+        return fenwick_sum(self.times, len(self.blocks)) / 1000
+
+    def length_before(self, index):
+        # The total length of the songs before a position in the queue, in seconds
+        index = self._index(index, insert=True)
+        if index == self.length:
+            return self.total_length()
+        b, i = self._locate(index)
+        time = fenwick_sum(self.times, b) + sum(song.length_ms for song in self.blocks[b][:i])
+        return time / 1000
+
+
+
+    # Changes
+
+    def insert(self, index, song):
+        index = self._index(index, insert=True)
+        self._added([song])
+        if not self.blocks:
+            self.blocks.append([song])
+            self.sums.append(None)
+            self.length = 1
+            self._rebuild()
+            return
+        if index == self.length:
+            b = len(self.blocks) - 1
+            i = len(self.blocks[b])
+        else:
+            b, i = self._locate(index)
+        block = self._writable(b)
+        block.insert(i, song)
+        song.queue_block = block
+        self.length += 1
+        if len(block) > 2 * QUEUE_BLOCK_SIZE:
+            self.sums[b] = None
+            self._rebuild()
+        else:
+            self._add(b, 1, song.length_ms)
+
+    def append(self, song):
+        self.insert(self.length, song)
+
+    def appendleft(self, song):
+        self.insert(0, song)
+
+    def splice(self, index, songs):
+        # Insert a sequence of songs at a position, in order
+        songs = list(songs)
+        if len(songs) <= 1:
+            for song in songs:
+                self.insert(index, song)
+            return
+        index = self._index(index, insert=True)
+        if index == self.length:
+            b, i = len(self.blocks), 0
+        else:
+            b, i = self._locate(index)
+        new = [songs[j:j+QUEUE_BLOCK_SIZE] for j in range(0, len(songs), QUEUE_BLOCK_SIZE)]
+        if b < len(self.blocks):
+            block = self.blocks[b]
+            new = [block[:i]] + new + [block[i:]]
+        self.blocks[b:b+1] = new
+        self.sums[b:b+1] = [None] * len(new)
+        self.length += len(songs)
+        self._added(songs)
+        self._rebuild()
+
+    def extend(self, songs):
+        self.splice(self.length, songs)
+
+    def extendleft(self, songs):
+        # Like deque.extendleft(), this reverses the order of the songs
+        self.splice(0, list(songs)[::-1])
+
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.delete_range(*self._slice(key))
+            return
+        b, i = self._locate(self._index(key))
+        song = self._writable(b).pop(i)
+        self.length -= 1
+        if len(self.blocks[b]) == QUEUE_MIN_BLOCK_SIZE - 1:
+            # the block has just got too small, so merge it with a neighbour
+            self.sums[b] = None
+            self._rebuild()
+        elif self.blocks[b]:
+            self._add(b, -1, -song.length_ms)
+        else:
+            self._rebuild()
+        self._removed([song])
+
+    def pop(self, index=-1):
+        if not self.length:
+            raise IndexError('pop from an empty queue')
+        index = self._index(index)
+        song = self[index]
+        del self[index]
+        return song
+
+    def popleft(self):
+        return self.pop(0)
+
+    def remove(self, song):
+        # Remove the first song equal to the given one (O(n) to find it)
+        del self[self.index(song)]
+
+    def delete_range(self, start, stop):
+        # Remove the songs from position start up to (not including) stop, and return them
+        start = self._index(start, insert=True)
+        stop = self._index(stop, insert=True)
+        if start >= stop:
+            return []
+        if stop - start == 1:
+            return [self.pop(start)]
+        removed = []
+        b, i = self._locate(start)
+        while len(removed) < stop - start:
+            block = self._writable(b)
+            n = min(len(block) - i, stop - start - len(removed))
+            self.sums[b] -= sum(song.length_ms for song in block[i:i+n])
+            removed.extend(block[i:i+n])
+            del block[i:i+n]
+            b += 1
+            i = 0
+        self.length -= len(removed)
+        self._rebuild()
+        self._removed(removed)
+        return removed
+
+    def delete_positions(self, positions):
+        # Remove the songs at some positions all in one pass (O(n)), and return them in order
+        positions = set(positions)
+        if not positions:
+            return []
+        kept = []
+        removed = []
+        for i, song in enumerate(self):
+            (removed if i in positions else kept).append(song)
+        self._fill(kept)
+        self._removed(removed)
+        return removed
+
+    def _fill(self, songs):
+        # Replace the blocks with new ones holding a list of songs (O(n))
+        self.blocks = [songs[j:j+QUEUE_BLOCK_SIZE] for j in range(0, len(songs), QUEUE_BLOCK_SIZE)]
+        self.sums = [None] * len(self.blocks)
+        self.length = len(songs)
+        self._rebuild()
+
+    def shuffle(self):
+        # Put the songs in a random order all at once (O(n)). random.shuffle() would work too,
+        # but it swaps songs one at a time, and each swap has to find both songs.
+        songs = list(self)
+        random.shuffle(songs)
+        self._fill(songs)
+
+    def rotate(self, n=1):
+        # Like deque.rotate(): move the last n songs to the front (or the first -n songs to the end)
+        if not self.length:
+            return
+        n %= self.length
+        if n:
+            self.splice(0, self.delete_range(self.length - n, self.length))
+
+    def clear(self):
+        self._removed(list(self))
+        self.blocks = []
+        self.sums = []
+        self.tree = fenwick([])
+        self.times = fenwick([])
+        self.index_of = {}
+        self.frozen = set()
+        self.length = 0
+        self.counts.clear()
+        self.renames = Song.renames
+        self.users.clear()
+
+
+
+
+class QueueSnapshot(object):
+
+    # The songs that were on a SongQueue at some moment, which later changes to the queue don't affect
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.starts = list(itertools.accumulate((len(block) for block in blocks), initial=0)) # position of each block
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def range(self, start, stop):
+        # Get a list of the songs from position start up to (not including) stop
+        songs = []
+        b = bisect.bisect_right(self.starts, start) - 1
+        while (start + len(songs) < stop) and (0 <= b < len(self.blocks)):
+            i = start + len(songs) - self.starts[b]
+            songs.extend(self.blocks[b][i:i + stop - start - len(songs)])
+            b += 1
+        return songs
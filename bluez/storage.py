@@ -0,0 +1,212 @@
+# Two-tier cache of downloaded audio: the download directory on local disk,
+# in front of an S3-compatible bucket that survives restarts
+
+import asyncio
+import hashlib
+import os
+import urllib.parse
+import logging
+
+from bluez.metrics import *
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+BLUEZ_DOWNLOAD_PATH = os.getenv('BLUEZ_DOWNLOAD_PATH')
+BLUEZ_S3_BUCKET = os.getenv('BLUEZ_S3_BUCKET')
+BLUEZ_S3_PREFIX = os.getenv('BLUEZ_S3_PREFIX', 'audio/')
+BLUEZ_S3_ENDPOINT = os.getenv('BLUEZ_S3_ENDPOINT') # e.g. http://localhost:9000 for MinIO; credentials come from the usual AWS_* variables
+BLUEZ_CACHE_MB = int(os.getenv('BLUEZ_CACHE_MB', '0')) # how much of the local disk to use; 0 means the cache is not kept, unless there is a bucket
+
+STORAGE_DEFAULT_CACHE_MB = 1024 # how much of the local disk to use in front of a bucket, if BLUEZ_CACHE_MB isn't set
+
+STORAGE_CHUNK_SIZE = 262144 # bytes to write at a time when filling the local cache from the bucket
+PARTIAL_EXTS = ('.part', '.tmp', '.ytdl') # files that are still being written, which must not be evicted
+
+
+
+
+def track_id(data):
+    # Get a canonical id for the track described by a youtube-dl info dict, which is the same
+    # however the track was found (e.g. a search or a link with extra query parameters)
+    extractor = data.get('extractor_key') or data.get('ie_key')
+    if extractor and data.get('id'):
+        return f'{extractor.lower()}/{urllib.parse.quote(str(data["id"]), safe="-_.")}'
+    link = data.get('webpage_url') or data.get('url') or ''
+    return 'url/' + hashlib.sha1(link.encode('utf-8')).hexdigest()
+
+
+
+
+class Storage(object):
+
+    # Keeps the download directory under a certain size by deleting the least recently used
+    # files, and keeps a copy of every download in a bucket, so that after a restart (which
+    # wipes the local disk) a track only has to be fetched from the bucket rather than
+    # downloaded through youtube-dl again. Bucket objects are named after the canonical
+    # track id and remember the extension of the file they were uploaded from.
+
+    def __init__(self, bucket=BLUEZ_S3_BUCKET, prefix=BLUEZ_S3_PREFIX, endpoint=BLUEZ_S3_ENDPOINT,
+                 path=BLUEZ_DOWNLOAD_PATH, max_bytes=BLUEZ_CACHE_MB * 1048576):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint = endpoint
+        self.path = path
+        self.max_bytes = max_bytes
+        self.s3 = None
+        self.uploading = set() # object keys being uploaded
+        if bucket and (boto3 is None):
+            logging.warning('boto3 is not installed, so the bucket will not be used')
+        if self.enabled and (self.max_bytes <= 0):
+            # downloads are kept as a cache whenever there is a bucket, so the cache needs a size,
+            # or the download directory would grow until the disk is full
+            logging.info(f'BLUEZ_CACHE_MB is not set, so keeping up to {STORAGE_DEFAULT_CACHE_MB} MB of downloads on disk')
+            self.max_bytes = STORAGE_DEFAULT_CACHE_MB * 1048576
+
+    @property
+    def enabled(self):
+        # True if there is a bucket to use
+        return bool(self.bucket) and (boto3 is not None)
+
+    @property
+    def keeps_files(self):
+        # True if downloaded files should be kept as a cache rather than cleared out
+        return self.enabled or (self.max_bytes > 0)
+
+
+    def client(self):
+        # Get the S3 client, creating it the first time
+        if self.s3 is None:
+            self.s3 = boto3.client('s3', endpoint_url=self.endpoint)
+        return self.s3
+
+
+    def object_key(self, track):
+        return self.prefix + track
+
+
+
+    def touch(self, path):
+        # Mark a file in the local cache as just used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+    def evict(self):
+        # Delete the least recently used files in the download directory until it is small enough
+        if not (self.path and (self.max_bytes > 0)):
+            return
+        try:
+            files = []
+            for entry in os.scandir(self.path):
+                if entry.is_file() and not entry.name.endswith(PARTIAL_EXTS):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            logging.warning(f'unable to read the download directory: {e}')
+            return
+        total = sum(size for mtime, size, path in files)
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                metrics.increment('cache_evictions')
+            except OSError:
+                pass
+        metrics.set('cache_bytes', total)
+
+
+
+    async def fetch(self, track, download):
+        # Fill the local cache from the bucket, writing the file in order so that it can
+        # be played while it is arriving, the same as a youtube-dl download. Returns True
+        # if the track was in the bucket.
+        if not self.enabled:
+            return False
+        loop = asyncio.get_event_loop()
+        try:
+            found = (await loop.run_in_executor(None, self._fetch, self.object_key(track), download))
+        except Exception as e:
+            logging.warning(f'unable to fetch {track} from the bucket: {e}')
+            return False
+        metrics.increment('storage_hits' if found else 'storage_misses')
+        return found
+
+
+    def _fetch(self, key, download):
+        # Download an object to the path of a Download (this blocks)
+        try:
+            response = self.client().get_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return False
+            raise
+        ext = response.get('Metadata', {}).get('ext')
+        if ext:
+            download.path = os.path.splitext(download.path)[0] + '.' + ext
+        download.total = response.get('ContentLength')
+        part = download.path + '.part'
+        try:
+            with open(part, 'wb') as o:
+                for chunk in response['Body'].iter_chunks(STORAGE_CHUNK_SIZE):
+                    o.write(chunk)
+                    o.flush()
+                    download.downloaded += len(chunk)
+            os.replace(part, download.path)
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        return True
+
+
+
+    def upload(self, track, path):
+        # Copy a downloaded file to the bucket in the background, if it isn't there already
+        key = self.object_key(track)
+        if (not self.enabled) or (key in self.uploading):
+            return
+        self.uploading.add(key)
+        asyncio.create_task(self._upload(key, path))
+
+
+    async def _upload(self, key, path):
+        loop = asyncio.get_event_loop()
+        try:
+            if (await loop.run_in_executor(None, self._upload_file, key, path)):
+                metrics.increment('storage_uploads')
+        except Exception as e:
+            logging.warning(f'unable to upload {path} to the bucket: {e}')
+            metrics.increment('storage_upload_errors')
+        finally:
+            self.uploading.discard(key)
+
+
+    def _upload_file(self, key, path):
+        # Upload a file unless there is already an object for it (this blocks)
+        client = self.client()
+        try:
+            client.head_object(Bucket=self.bucket, Key=key)
+            return False
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+        ext = os.path.splitext(path)[1].lstrip('.')
+        client.upload_file(path, self.bucket, key, ExtraArgs={'Metadata': {'ext': ext}})
+        return True
+
+
+
+
+storage = Storage()
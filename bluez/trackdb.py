@@ -0,0 +1,94 @@
+# Persistent cache of per-track analysis results
+
+import asyncio
+import collections
+import json
+import os
+import logging
+
+
+BLUEZ_SETTINGS_PATH = os.getenv('BLUEZ_SETTINGS_PATH')
+BLUEZ_TRACKDB_PATH = os.getenv('BLUEZ_TRACKDB_PATH') or \
+                     (os.path.join(BLUEZ_SETTINGS_PATH, 'bluez_tracks.json') if BLUEZ_SETTINGS_PATH else None)
+
+TRACKDB_MAX_TRACKS = 20000 # the number of tracks to remember, least recently updated are forgotten first
+TRACKDB_SAVE_DELAY = 30 # seconds to wait after a change before writing the file, so changes are batched
+
+
+
+
+class TrackDB(object):
+
+    # Information about tracks that is expensive to work out (e.g. loudness),
+    # keyed by the track's link so it is shared between guilds. If a path is
+    # given, it is kept in a JSON file so that it survives restarts.
+
+    def __init__(self, path=BLUEZ_TRACKDB_PATH, max_tracks=TRACKDB_MAX_TRACKS):
+        self.path = path
+        self.max_tracks = max_tracks
+        self.tracks = None # key -> dict of fields, loaded on first use
+        self.save_handle = None
+
+
+    def load(self):
+        # Load the file if we haven't yet
+        if self.tracks is not None:
+            return
+        self.tracks = collections.OrderedDict()
+        if not (self.path and os.path.exists(self.path)):
+            return
+        try:
+            with open(self.path, 'r') as o:
+                self.tracks.update(json.load(o))
+        except (IOError, ValueError) as e:
+            logging.warning(f'error loading track database: {e}')
+
+
+    def get(self, key, field, default=None):
+        # Get a field for a track
+        self.load()
+        return self.tracks.get(key, {}).get(field, default)
+
+
+    def has(self, key, field):
+        # Return True if a field has been stored for a track
+        self.load()
+        return field in self.tracks.get(key, {})
+
+
+    def update(self, key, **fields):
+        # Store some fields for a track
+        self.load()
+        entry = self.tracks.pop(key, {})
+        entry.update(fields)
+        self.tracks[key] = entry
+        while len(self.tracks) > self.max_tracks:
+            self.tracks.popitem(last=False)
+        self.schedule_save()
+
+
+    def schedule_save(self):
+        # Write the file soon, unless that's already been arranged
+        if self.path and (self.save_handle is None):
+            self.save_handle = asyncio.get_event_loop().call_later(TRACKDB_SAVE_DELAY, self.save)
+
+
+    def save(self):
+        # Write the file now
+        self.save_handle = None
+        if not self.path:
+            return False
+        temp = self.path + '.tmp'
+        try:
+            with open(temp, 'w') as o:
+                json.dump(self.tracks, o)
+            os.replace(temp, self.path)
+            return True
+        except IOError as e:
+            logging.warning(f'error writing track database: {e}')
+            return False
+
+
+
+
+trackdb = TrackDB()
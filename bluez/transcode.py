@@ -0,0 +1,119 @@
+# Background conversion of downloaded songs to Ogg/Opus
+
+import asyncio
+import os
+import logging
+
+from bluez.admission import *
+from bluez.metrics import *
+from bluez.util import *
+
+
+BLUEZ_TRANSCODE = bool(int(os.getenv('BLUEZ_TRANSCODE', '1')))
+BLUEZ_TRANSCODE_WORKERS = int(os.getenv('BLUEZ_TRANSCODE_WORKERS', '1'))
+
+TRANSCODE_GAIN = 0.5 # gain baked into transcoded files, the same as the default playback volume
+TRANSCODE_EXT = '.opus'
+
+
+
+
+class Transcoder(object):
+
+    # A pool of background workers that re-encode downloaded files as Ogg/Opus at the
+    # bitrate of the voice channel, so that playing them without any audio effects does
+    # not need to decode or encode anything. Channels with different bitrates get files
+    # of their own, so everything here is keyed on (path, bitrate).
+
+    def __init__(self, workers=BLUEZ_TRANSCODE_WORKERS):
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.jobs = {} # (path, bitrate) -> future resolved once the file has been transcoded (or failed to)
+        self.done = {} # (path, bitrate) -> (path of the transcoded file, gain baked into it)
+
+
+    def start(self):
+        # Start the worker tasks
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for i in range(self.workers)]
+
+
+    def submit(self, path, bitrate, gain=TRANSCODE_GAIN):
+        # Queue a file to be transcoded at a bitrate, unless it has been already
+        if ((path, bitrate) in self.done) or ((path, bitrate) in self.jobs):
+            return
+        if self.queue is None:
+            self.start()
+        self.jobs[path, bitrate] = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((path, bitrate, gain))
+        metrics.set('transcode_queue', self.queue.qsize())
+
+
+    def lookup(self, path, bitrate):
+        # Return a tuple (path of the transcoded file, gain baked into it) if the given file has been
+        # transcoded at the given bitrate
+        result = self.done.get((path, bitrate))
+        if (result is not None) and not os.path.exists(result[0]):
+            # the download directory has been cleared out since then
+            del self.done[path, bitrate]
+            result = None
+        return result
+
+
+    async def wait(self, path, bitrate):
+        # Wait for a file to finish transcoding at a bitrate, if it is being transcoded
+        future = self.jobs.get((path, bitrate))
+        if future is not None:
+            await asyncio.shield(future)
+        return self.lookup(path, bitrate)
+
+
+    async def worker(self):
+        while True:
+            path, bitrate, gain = (await self.queue.get())
+            future = self.jobs[path, bitrate]
+            try:
+                self.done[path, bitrate] = ((await self.transcode(path, bitrate, gain)), gain)
+            except Exception as e:
+                logging.warning(f'unable to transcode "{path}": {e}')
+            finally:
+                del self.jobs[path, bitrate]
+                future.set_result(None)
+                metrics.set('transcode_queue', self.queue.qsize())
+
+
+    async def transcode(self, path, bitrate, gain):
+        # Transcode a single file once the admission controller lets us start ffmpeg
+        ticket = (await admission.acquire(BACKGROUND, priority=PRIORITY_BACKGROUND))
+        try:
+            return (await self.run_ffmpeg(path, bitrate, gain))
+        finally:
+            ticket.release()
+
+
+    async def run_ffmpeg(self, path, bitrate, gain):
+        # Transcode a single file, and return the path of the new file.
+        # The original is left alone, since other songs may still refer to it.
+        output = os.path.splitext(path)[0] + f'-transcoded-{bitrate}k' + TRANSCODE_EXT
+        temp = output + '.part'
+        process = (await asyncio.create_subprocess_exec(
+            'ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', path, '-vn', '-map_metadata', '-1',
+            '-af', f'volume={gain:.6g}', '-c:a', 'libopus', '-b:a', f'{bitrate}k', '-ar', '48000', '-ac', '2',
+            '-f', 'ogg', temp,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE))
+        stdout, stderr = (await process.communicate())
+        if process.returncode != 0:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise RuntimeError(stderr.decode('latin-1').strip() or f'ffmpeg exited with code {process.returncode}')
+        os.replace(temp, output)
+        metrics.increment('transcoded_files')
+        return output
+
+
+
+
+transcoder = Transcoder()
@@ -1,6 +1,7 @@
 # Miscellaneous utilities
 
 import discord
+import functools
 import sys
 import re
 import asyncio
@@ -9,6 +10,8 @@ import traceback
 
 ESC = discord.utils.escape_markdown
 
+FORMAT_CACHE_SIZE = 4096 # formatted user names and song links to remember, since long lists show the same ones over and over
+
 
 def format_time(time):
     time = int(round(time))
@@ -21,17 +24,35 @@ def format_time(time):
 
 
 def format_user(user):
-    str = user.name
-    if getattr(user, 'nick', None):
-        str = f'{ESC(user.nick)} ({ESC(str)})'
+    return format_user_name(user.name, getattr(user, 'nick', None))
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def format_user_name(name, nick):
+    str = name
+    if nick:
+        str = f'{ESC(nick)} ({ESC(str)})'
     return str
 
 
 def format_link(song):
-    if getattr(song, 'link', None):
-        return f'[{ESC(song.name)}]({song.link})'
+    return format_name_link(song.name, getattr(song, 'link', None))
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def format_name_link(name, link):
+    if link:
+        return f'[{ESC(name)}]({link})'
     else:
-        return song.name
+        return name
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def format_timestamp(timestamp, timezone=None):
+    # Format a time in a time zone (or as it is, if timezone is None)
+    if timezone:
+        timestamp = timestamp.astimezone(timezone)
+    return timestamp.strftime('%x %X')
 
 
 def is_url(string):
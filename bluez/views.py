@@ -1,12 +1,14 @@
 # Discord UI view classes
 
 import discord
+import collections
 
 from bluez.song import *
 from bluez.util import *
 
 SEARCH_PREV_NEXT = False # whether to enable page switching in the search embed
 MAX_SEARCH_PAGES = 20 # the maximum number of pages to show in the search embed
+LAZY_PAGE_CACHE = 4 # the number of pages of a LazyPages to keep once they have been made
 
 
 
@@ -71,6 +73,34 @@ async def yesno(ctx, text):
 # View with prev/next buttons for viewing a multipage embed
 
 
+class LazyPages(object):
+
+    # A list of embeds that are only made when someone looks at them, so that posting a long
+    # list (like the queue) doesn't mean making every page up front. render(i) makes page i.
+    # It can be given to post_multipage_embed() in place of a list of embeds.
+
+    def __init__(self, npages, render):
+        self.npages = npages
+        self.render = render
+        self.pages = collections.OrderedDict() # the pages made most recently
+
+    def __len__(self):
+        return self.npages
+
+    def __getitem__(self, index):
+        if not (0 <= index < self.npages):
+            raise IndexError('page index out of range')
+        if index in self.pages:
+            self.pages.move_to_end(index)
+        else:
+            self.pages[index] = self.render(index)
+            if len(self.pages) > LAZY_PAGE_CACHE:
+                self.pages.popitem(last=False)
+        return self.pages[index]
+
+
+
+
 class MultipageEmbedView(discord.ui.View):
 
     def __init__(self, message, embeds, current_page, timeout=30):
@@ -0,0 +1,155 @@
+# Tests for bluez.relay against a local HTTP server standing in for the upstream CDN
+# Run from the top of the repository with: python -m unittest discover tests
+
+import asyncio
+import os
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+import bluez.relay
+from bluez.relay import *
+
+
+
+class RelayTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.files = {'a': os.urandom(3 * RELAY_BLOCK_SIZE + 1234), 'b': os.urandom(2 * RELAY_BLOCK_SIZE + 99)}
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/{name}', self.upstream)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.upstream_url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+        self.session = aiohttp.ClientSession()
+        self.relays = []
+
+    async def asyncTearDown(self):
+        for relay in self.relays:
+            await relay.close()
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def upstream(self, request):
+        # Serve ranged requests for self.files, the way a CDN does
+        data = self.files[request.match_info['name']]
+        self.requests.append(request.headers.get('Range'))
+        first, last = request.headers['Range'][len('bytes='):].split('-')
+        first = int(first)
+        last = min(int(last), len(data) - 1)
+        return web.Response(status=206, body=data[first:last+1],
+                            headers={'Content-Range': f'bytes {first}-{last}/{len(data)}'})
+
+    async def start_relay(self, **kwargs):
+        relay = MediaRelay(**kwargs)
+        await relay.start()
+        self.relays.append(relay)
+        return relay
+
+    async def read(self, url, first=None, last=None):
+        headers = {}
+        if first is not None:
+            headers['Range'] = f'bytes={first}-{"" if last is None else last}'
+        async with self.session.get(url, headers=headers) as response:
+            return response.status, (await response.read())
+
+
+    async def test_whole_file(self):
+        relay = await self.start_relay()
+        url = relay.register('a', f'{self.upstream_url}/a')
+        status, data = (await self.read(url))
+        self.assertEqual(status, 200)
+        self.assertEqual(data, self.files['a'])
+
+    async def test_range(self):
+        relay = await self.start_relay()
+        url = relay.register('a', f'{self.upstream_url}/a')
+        first = RELAY_BLOCK_SIZE - 10
+        status, data = (await self.read(url, first, first + 99))
+        self.assertEqual(status, 206)
+        self.assertEqual(data, self.files['a'][first:first+100])
+
+    async def test_cached(self):
+        # reading the file again doesn't fetch it again, and reading it from a new upstream URL
+        # only fetches one block again to check that it is still the same file
+        relay = await self.start_relay()
+        url = relay.register('a', f'{self.upstream_url}/a')
+        await self.read(url)
+        count = len(self.requests)
+        self.assertEqual((await self.read(url))[1], self.files['a'])
+        self.assertEqual(len(self.requests), count)
+        relay.register('a', f'{self.upstream_url}/a?expires=later')
+        self.assertEqual((await self.read(url, 5))[1], self.files['a'][5:])
+        self.assertEqual(self.requests[count:], [f'bytes=0-{RELAY_BLOCK_SIZE - 1}'])
+
+    async def test_concurrent_readers(self):
+        relay = await self.start_relay()
+        url = relay.register('a', f'{self.upstream_url}/a')
+        results = (await asyncio.gather(*[self.read(url) for i in range(4)]))
+        for status, data in results:
+            self.assertEqual(data, self.files['a'])
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_different_file(self):
+        # if the same key starts serving a different file, the old blocks are not used
+        relay = await self.start_relay()
+        url = relay.register('a', f'{self.upstream_url}/a')
+        await self.read(url)
+        relay.register('a', f'{self.upstream_url}/b')
+        status, data = (await self.read(url, RELAY_BLOCK_SIZE))
+        self.assertEqual(data, self.files['b'][RELAY_BLOCK_SIZE:])
+        self.assertEqual((await self.read(url))[1], self.files['b'])
+
+    async def test_cache_limit(self):
+        # a file bigger than the whole cache doesn't stay in memory
+        relay = await self.start_relay(max_cache=RELAY_BLOCK_SIZE)
+        self.files['a'] = os.urandom(RELAY_FETCH_BLOCKS * 3 * RELAY_BLOCK_SIZE)
+        url = relay.register('a', f'{self.upstream_url}/a')
+        self.assertEqual((await self.read(url))[1], self.files['a'])
+        self.assertLessEqual(relay.cache_size, RELAY_FETCH_BLOCKS * RELAY_BLOCK_SIZE)
+        url = relay.register('b', f'{self.upstream_url}/b')
+        self.assertEqual((await self.read(url))[1], self.files['b'])
+        self.assertNotIn('a', [media.key for media in relay.media.values() if media.blocks])
+
+    async def test_evicted_while_streaming(self):
+        # a track whose blocks are evicted while ffmpeg is reading it can still be read, and read again
+        relay = await self.start_relay(max_cache=RELAY_BLOCK_SIZE)
+        url_a = relay.register('a', f'{self.upstream_url}/a')
+        url_b = relay.register('b', f'{self.upstream_url}/b')
+        async with self.session.get(url_a, headers={'Range': 'bytes=0-'}) as response:
+            self.assertEqual(response.status, 206)
+            first = (await response.content.readexactly(RELAY_BLOCK_SIZE))
+            self.assertEqual((await self.read(url_b)), (200, self.files['b']))
+            rest = (await response.read())
+        self.assertEqual(first + rest, self.files['a'])
+        # ffmpeg reconnecting for the rest of the track
+        self.assertEqual((await self.read(url_a, RELAY_BLOCK_SIZE)), (206, self.files['a'][RELAY_BLOCK_SIZE:]))
+        self.assertEqual(relay.cache_size, sum(media.size for media in relay.media.values()))
+
+    async def test_get_relay(self):
+        # callers that ask for the relay while it is starting get one that is listening
+        bluez.relay.relay = None
+        bluez.relay.relay_starting = None
+        try:
+            async def started():
+                relay = (await get_relay())
+                return relay, relay.base_url
+            results = (await asyncio.gather(*[started() for i in range(3)]))
+            self.relays.append(results[0][0])
+            for relay, base_url in results:
+                self.assertIs(relay, results[0][0])
+                self.assertIsNotNone(base_url)
+            url = results[0][0].register('a', f'{self.upstream_url}/a')
+            self.assertTrue(url.startswith('http://127.0.0.1:'))
+            self.assertEqual((await self.read(url))[1], self.files['a'])
+        finally:
+            bluez.relay.relay = None
+
+
+
+if __name__ == '__main__':
+    unittest.main()
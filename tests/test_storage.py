@@ -0,0 +1,166 @@
+# Tests for bluez.storage against a bucket mocked with moto, and the downloader that uses it
+# Run from the top of the repository with: python -m unittest discover tests
+# These need moto (pip install moto), and are skipped without it
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import boto3
+
+try:
+    import moto
+except ImportError:
+    moto = None
+
+import bluez.download
+from bluez.download import Download, Downloader
+from bluez.storage import *
+
+
+
+BUCKET = 'bluez-test'
+
+
+
+class FakeYoutubeDL(object):
+
+    # Stands in for yt_dlp.YoutubeDL; "downloads" a track by writing the bytes in data['content']
+
+    def __init__(self, params):
+        self.params = params
+
+    def prepare_filename(self, data):
+        return os.path.join(self.params['paths']['home'], f'{data["id"]}.webm')
+
+    def process_ie_result(self, data, download=True):
+        path = self.prepare_filename(data)
+        with open(path, 'wb') as o:
+            o.write(data['content'])
+        return {'requested_downloads': [{'filepath': path}]}
+
+
+
+@unittest.skipIf(moto is None, 'moto is not installed')
+class StorageTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.mock = moto.mock_aws()
+        self.mock.start()
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = self.tempdir.name
+
+    async def asyncTearDown(self):
+        self.mock.stop()
+        self.tempdir.cleanup()
+
+    def make_storage(self, max_bytes=0):
+        return Storage(bucket=BUCKET, prefix='audio/', endpoint=None, path=self.path, max_bytes=max_bytes)
+
+    def objects(self, storage):
+        response = storage.client().list_objects_v2(Bucket=BUCKET)
+        return sorted(item['Key'] for item in response.get('Contents', []))
+
+    async def download(self, storage, data):
+        # Download a track through a Downloader that uses the given storage, and wait for it
+        ydl = FakeYoutubeDL({'paths': {'home': self.path}})
+        with mock.patch.object(bluez.download, 'storage', storage), \
+             mock.patch.object(bluez.download.yt_dlp, 'YoutubeDL', FakeYoutubeDL):
+            download = Downloader().start(ydl, data)
+            await download.task
+            # let the background upload finish
+            while storage.uploading:
+                await asyncio.sleep(0.01)
+        return download
+
+    def track(self, name, content):
+        return {'extractor_key': 'Youtube', 'id': name, 'content': content}
+
+
+    async def test_default_cache_size(self):
+        # with a bucket and no BLUEZ_CACHE_MB, the download directory is still kept to a size
+        storage = self.make_storage()
+        self.assertEqual(storage.max_bytes, STORAGE_DEFAULT_CACHE_MB * 1048576)
+        self.assertTrue(storage.keeps_files)
+        storage = self.make_storage(max_bytes=5 * 1048576)
+        self.assertEqual(storage.max_bytes, 5 * 1048576)
+        # without a bucket, 0 still means the downloads are not kept
+        storage = Storage(bucket=None, path=self.path, max_bytes=0)
+        self.assertEqual(storage.max_bytes, 0)
+        self.assertFalse(storage.keeps_files)
+
+
+    async def test_upload_after_download(self):
+        storage = self.make_storage()
+        content = os.urandom(100000)
+        download = await self.download(storage, self.track('abc', content))
+        self.assertTrue(download.done)
+        self.assertIsNone(download.error)
+        self.assertEqual(self.objects(storage), ['audio/youtube/abc'])
+        response = storage.client().get_object(Bucket=BUCKET, Key='audio/youtube/abc')
+        self.assertEqual(response['Metadata'].get('ext'), 'webm')
+        self.assertEqual(response['Body'].read(), content)
+        # a second upload of the same track doesn't replace the object
+        self.assertFalse(storage._upload_file('audio/youtube/abc', download.path))
+
+
+    async def test_fetch_from_bucket(self):
+        # after a restart the local disk is empty, but the track is still in the bucket
+        storage = self.make_storage()
+        content = os.urandom(3 * STORAGE_CHUNK_SIZE + 17)
+        download = await self.download(storage, self.track('abc', content))
+        os.remove(download.path)
+        data = self.track('abc', None) # would fail if youtube-dl were asked for it
+        download = await self.download(storage, data)
+        self.assertTrue(download.done)
+        self.assertIsNone(download.error)
+        self.assertEqual(download.path, os.path.join(self.path, 'abc.webm'))
+        self.assertEqual(download.total, len(content))
+        self.assertEqual(download.downloaded, len(content))
+        with open(download.path, 'rb') as o:
+            self.assertEqual(o.read(), content)
+        self.assertFalse(os.path.exists(download.path + '.part'))
+
+
+    async def test_fetch_miss(self):
+        storage = self.make_storage()
+        download = Download(os.path.join(self.path, 'missing.webm'))
+        self.assertFalse(await storage.fetch('youtube/missing', download))
+        self.assertEqual(os.listdir(self.path), [])
+        # without a bucket, nothing is fetched
+        storage = Storage(bucket=None, path=self.path, max_bytes=0)
+        self.assertFalse(await storage.fetch('youtube/missing', download))
+
+
+    async def test_evict_least_recently_used(self):
+        storage = self.make_storage(max_bytes=250000)
+        paths = []
+        for i, name in enumerate(('a', 'b', 'c')):
+            path = os.path.join(self.path, f'{name}.webm')
+            with open(path, 'wb') as o:
+                o.write(os.urandom(100000))
+            os.utime(path, (1000 + i, 1000 + i))
+            paths.append(path)
+        # a file that is still being written is never evicted
+        with open(os.path.join(self.path, 'd.webm.part'), 'wb') as o:
+            o.write(os.urandom(100000))
+        os.utime(os.path.join(self.path, 'd.webm.part'), (0, 0))
+        # using a file makes it the most recently used
+        storage.touch(paths[0])
+        storage.evict()
+        self.assertEqual(sorted(os.listdir(self.path)), ['a.webm', 'c.webm', 'd.webm.part'])
+        # nothing more goes while it fits
+        storage.evict()
+        self.assertEqual(sorted(os.listdir(self.path)), ['a.webm', 'c.webm', 'd.webm.part'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
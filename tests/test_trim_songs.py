@@ -0,0 +1,170 @@
+# Tests for the duplicate handling in Player.trim_songs() and Player.removedupes(),
+# checked against the list-based versions they replaced.
+# Run from the top of the repository with: python -m unittest discover tests
+
+import asyncio
+import random
+import types
+import unittest
+
+from bluez.player import Player
+from bluez.song import Song
+from bluez.songqueue import SongQueue
+
+
+
+def make_song(k):
+    # A Song without going through youtube-dl; songs with the same k are duplicates
+    song = Song.__new__(Song)
+    song.name = f'song {k}'
+    song.link = f'https://example.com/{k}'
+    song.user = None
+    song.queue = None
+    song.queue_block = None
+    song.length = 60
+    song.dropped = False
+    return song
+
+
+def old_trim(queue, queue_end, songs, cutoff):
+    # What trim_songs() used to do with preventduplicates on
+    queue = list(queue)
+    songs = songs.copy()
+    pre_queue = queue[:cutoff]
+    post_queue = queue[cutoff:]
+    orig_songs = songs.copy()
+    for i, song in enumerate(orig_songs):
+        if (song in pre_queue) or (song in orig_songs[:i]):
+            songs.remove(song)
+        elif song in post_queue:
+            if queue.index(song) < queue_end:
+                queue_end -= 1
+            queue.remove(song)
+    return queue, queue_end, songs
+
+
+def old_removedupes(queue, queue_end):
+    # What removedupes() used to do
+    queue = list(queue)
+    original = tuple(queue)
+    for i, song in enumerate(original):
+        if song in original[:i]:
+            if queue.index(song) < queue_end:
+                queue_end -= 1
+            queue.remove(song)
+    return queue, queue_end
+
+
+def make_player(queue, queue_end):
+    # Just enough of a Player for trim_songs() and removedupes()
+    player = types.SimpleNamespace(djplaylists=False, maxqueuelength=0, maxusersongs=0, preventduplicates=True,
+                                   queue=SongQueue(queue), queue_end=queue_end, now_playing=None,
+                                   mutex=asyncio.Lock())
+    player.drop_songs = lambda songs: Player.drop_songs(player, songs)
+    player.remove_positions = lambda positions: Player.remove_positions(player, positions)
+    return player
+
+
+class Context(object):
+    async def send(self, *args, **kwargs):
+        pass
+
+
+
+class TrimSongsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def trim(self, queue, queue_end, songs, where, priority):
+        # Run trim_songs() and check it against old_trim(); returns the player and the songs kept
+        if where == 'Bottom':
+            cutoff = (queue_end if priority else len(queue))
+        elif where == 'Shuffle':
+            cutoff = len(queue)
+        else:
+            cutoff = 0
+        old_queue, old_queue_end, old_songs = old_trim(queue, queue_end, songs, cutoff)
+        player = make_player(queue, queue_end)
+        kept = (await Player.trim_songs(player, Context(), songs, where, priority, anonymous=True))
+        self.assertEqual([id(song) for song in player.queue], [id(song) for song in old_queue])
+        self.assertEqual([id(song) for song in kept], [id(song) for song in old_songs])
+        self.assertEqual(player.queue_end, old_queue_end)
+        # the songs thrown out of the playlist or moved off the queue are dropped, and nothing else
+        left = list(player.queue) + kept
+        for song in queue + songs:
+            self.assertEqual(song.dropped, not any(song is other for other in left))
+        return player, kept
+
+    async def test_keep(self):
+        # a song already ahead of where the playlist goes is thrown out of the playlist
+        queue = [make_song(k) for k in (1, 2, 3)]
+        songs = [make_song(k) for k in (2, 4)]
+        player, kept = (await self.trim(queue, 0, songs, 'Bottom', False))
+        self.assertEqual([song.name for song in kept], ['song 4'])
+        self.assertEqual(len(player.queue), 3)
+
+    async def test_move(self):
+        # a song queued after where the playlist goes is moved up to it
+        queue = [make_song(k) for k in (1, 2, 3)]
+        songs = [make_song(k) for k in (3, 4)]
+        player, kept = (await self.trim(queue, 2, songs, 'Top', False))
+        self.assertEqual([song.name for song in kept], ['song 3', 'song 4'])
+        self.assertEqual([song.name for song in player.queue], ['song 1', 'song 2'])
+
+    async def test_move_queue_end(self):
+        # moving a song from ahead of the priority marker moves the marker with it
+        queue = [make_song(k) for k in (1, 2, 3, 4)]
+        songs = [make_song(2)]
+        player, kept = (await self.trim(queue, 3, songs, 'Top', False))
+        self.assertEqual(player.queue_end, 2)
+
+    async def test_priority(self):
+        # with priority, songs after the priority marker are moved up to it
+        queue = [make_song(k) for k in (1, 2, 3, 4)]
+        songs = [make_song(k) for k in (1, 4, 4)]
+        player, kept = (await self.trim(queue, 2, songs, 'Bottom', True))
+        self.assertEqual([song.name for song in kept], ['song 4'])
+        self.assertIs(kept[0], songs[2])
+        self.assertEqual(player.queue_end, 2)
+
+    async def test_random(self):
+        rnd = random.Random(0)
+        for trial in range(500):
+            keys = rnd.randint(1, 12)
+            queue = [make_song(rnd.randrange(keys)) for i in range(rnd.randint(0, 25))]
+            songs = [make_song(rnd.randrange(keys)) for i in range(rnd.randint(1, 10))]
+            with self.subTest(trial=trial):
+                await self.trim(queue, rnd.randint(0, len(queue)), songs,
+                                rnd.choice(['Bottom', 'Top', 'Shuffle', 'Now']), rnd.random() < 0.5)
+
+
+
+class RemoveDupesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def removedupes(self, queue, queue_end):
+        old_queue, old_queue_end = old_removedupes(queue, queue_end)
+        player = make_player(queue, queue_end)
+        await Player.removedupes(player, Context())
+        self.assertEqual([id(song) for song in player.queue], [id(song) for song in old_queue])
+        self.assertEqual(player.queue_end, old_queue_end)
+        for song in queue:
+            self.assertEqual(song.dropped, not any(song is other for other in player.queue))
+        return player
+
+    async def test_last_copy_kept(self):
+        queue = [make_song(k) for k in (1, 2, 1, 3, 2)]
+        player = (await self.removedupes(queue, 3))
+        self.assertEqual([song.name for song in player.queue], ['song 1', 'song 3', 'song 2'])
+        self.assertIs(player.queue[0], queue[2])
+        self.assertEqual(player.queue_end, 1)
+
+    async def test_random(self):
+        rnd = random.Random(1)
+        for trial in range(500):
+            keys = rnd.randint(1, 12)
+            queue = [make_song(rnd.randrange(keys)) for i in range(rnd.randint(0, 25))]
+            with self.subTest(trial=trial):
+                await self.removedupes(queue, rnd.randint(0, len(queue)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()